@@ -1,67 +1,344 @@
 from PyQt6.QtCore import (
     QObject,
     pyqtSignal,
+    pyqtSlot,
     QTimer,
     QThread,
+    QFileSystemWatcher,
+    QMetaObject,
+    QCoreApplication,
+    Qt,
 )
 from input_output import DataPacket
 from pathlib import Path
-from input_output import save_data_to_hdf5, DEFAULT_DIR
+from input_output import save_data_to_hdf5, DEFAULT_DIR, dataset_cache, handle_pool
+from concurrent.futures import ThreadPoolExecutor
 import time
 import os
 from typing import Dict
 
+# Number of packets refreshed in parallel by the backend thread
+LOADER_WORKERS = 4
+
+# Errors h5py raises when reading a file that a (non-SWMR) writer is still
+# writing, the read is retried later. RuntimeError and KeyError only count
+# when h5py raised them, see is_read_error()
+READ_ERRORS = (OSError, RuntimeError, KeyError)
+
+# Seconds before a source that could not be read is tried again while its
+# file is unchanged. Doubles with every failure up to MAX_RETRY_INTERVAL.
+RETRY_INTERVAL = 1.0
+MAX_RETRY_INTERVAL = 60.0
+
+# Seconds between refreshes of all sources while the folder is watched, for
+# writes that produce no file system event (e.g. from another host to a share)
+WATCHED_POLL_INTERVAL = 5.0
+
+
+def is_read_error(error):
+    """
+    True if the error comes from reading a half-written file rather than from
+    a bug: any OSError, or a RuntimeError or KeyError raised inside h5py.
+    """
+    if isinstance(error, OSError):
+        return True
+    if not isinstance(error, READ_ERRORS):
+        return False
+    traceback = error.__traceback__
+    while traceback.tb_next is not None:
+        traceback = traceback.tb_next
+    return traceback.tb_frame.f_globals.get('__name__', '').startswith('h5py')
+
+
+def file_state(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def dirty_parts(names):
+    """
+    Group changed HDF5 names of a packet by graph and part.
+
+    Returns:
+        dict: graph -> set of changed parts, or None if the whole graph changed.
+              Top-level entries such as "iter" or "metadata" map to None as well.
+    """
+    dirty = {}
+    for name in names:
+        graph, *rest = name.strip('/').split('/')
+        if len(rest) >= 2:
+            parts = dirty.setdefault(graph, set())
+            if parts is not None:
+                parts.add(rest[0])
+        else:
+            dirty[graph] = None
+    return dirty
+
+
+def source_files(folder):
+    return [Path(folder) / str(f) for f in os.listdir(folder) if f.endswith(".h5") or f.endswith(".hdf5")]
+
+
+class SourceWatcher(QObject):
+    '''
+    Reports data files appearing in, changing in and disappearing from a folder.
+
+    Uses QFileSystemWatcher (inotify on Linux), so unchanged files cost nothing.
+    If the folder cannot be watched, active is False and the owner has to call
+    poll() itself. Files the platform refused to watch are listed in unwatched.
+    '''
+    sourceAdded = pyqtSignal(str)
+    sourceModified = pyqtSignal(str)
+    sourceRemoved = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self.poll)
+        self._watcher.fileChanged.connect(self._onFileChanged)
+
+        self.folder = None
+        self.files = set()
+        self.unwatched = set()
+        self.active = False
+
+    def watch(self, folder):
+        if self._watcher.directories() or self._watcher.files():
+            self._watcher.removePaths(self._watcher.directories() + self._watcher.files())
+        for file in self.files:
+            self.sourceRemoved.emit(file)
+
+        self.folder = str(folder)
+        self.files = set()
+        self.unwatched = set()
+        self.active = os.path.isdir(self.folder) and self._watcher.addPath(self.folder)
+        self.poll()
+
+    def poll(self, *args):
+        if not os.path.isdir(self.folder):
+            current = set()
+        else:
+            current = set(str(f) for f in source_files(self.folder))
+
+        for file in sorted(current - self.files):
+            if not (self.active and self._watcher.addPath(file)):
+                self.unwatched.add(file)
+            self.sourceAdded.emit(file)
+
+        for file in self.files - current:
+            self._watcher.removePath(file)
+            self.unwatched.discard(file)
+            self.sourceRemoved.emit(file)
+
+        self.files = current
+
+    def _onFileChanged(self, path):
+        if not os.path.exists(path):
+            self.poll()
+            return
+        # Files replaced by a rename drop out of the watch list
+        if path not in self._watcher.files() and not self._watcher.addPath(path):
+            self.unwatched.add(path)
+        self.sourceModified.emit(path)
+
+
 class CoreBackend(QObject):
+    '''
+    Keeps the data packets of the source folder up to date.
+
+    The backend lives in its own QThread: all file access happens there and
+    the GUI only receives read-only snapshots of the packets via dataReady,
+    together with what changed: source -> dirty_parts() of that source, or
+    None when all of it is new.
+    dataReady is only emitted when something changed.
+    '''
     layoutReady = pyqtSignal()
-    dataReady = pyqtSignal()
+    dataReady = pyqtSignal(dict, dict)
     configChanged = pyqtSignal()
 
+    _startTimer = pyqtSignal(int)
+    _stopTimer = pyqtSignal()
+
     def __init__(self):
         super().__init__()
 
         self.layout = set([])
         self.data_packets : Dict[str, DataPacket] = {}
+        self.snapshots = {}
 
         self._check_source_folder = True
+        self._rescan = True
+        self._dirty = set()
+        self._last_poll = None
+        # Sources found since the last refresh, opened by the next one
+        self._new = set()
+        # Sources that could not be opened yet
+        self._pending = set()
+        # Sources whose last read failed -> (file state, time of the next
+        # retry, seconds between retries)
+        self._failing = {}
+        # Created in the backend thread on the first refresh
+        self.watcher : SourceWatcher = None
 
-        self.timer = QTimer()
+        # Slots are decorated, so the connections are queued into the backend
+        # thread once the backend has moved there
+        self.timer = QTimer(self)
         self.timer.timeout.connect(self.updateData)
 
         self._timeout = 1000  # Default timeout in milliseconds
 
         self._sourceFolder = DEFAULT_DIR
 
-        self.add_from_source_folder()
+        self._lazy = False
+        self._append_only = False
+
+        self._executor = ThreadPoolExecutor(max_workers=LOADER_WORKERS)
+
+        self._thread = QThread()
+        self.moveToThread(self._thread)
+        self._startTimer.connect(self.timer.start)
+        self._stopTimer.connect(self.timer.stop)
+        self._thread.start()
 
     def _addSource(self, file):
-        if file in self.data_packets:
-            return
-        data_packet = DataPacket(source=file)
-        self.data_packets[str(file)] = data_packet
+        self._addSources([file])
+
+    def _addSources(self, files):
+        # Opening loads a packet in full, so new sources are opened in parallel
+        files = [str(file) for file in files if str(file) not in self.data_packets]
+        for file, data_packet, error in self._executor.map(self._openPacket, files):
+            if data_packet is None:
+                # Most likely still being written, retried when it changes
+                if file not in self._pending:
+                    print(f"Could not open {file}: {error}")
+                    self._pending.add(file)
+                self._failed(file)
+                continue
+            self._pending.discard(file)
+            self._failing.pop(file, None)
+            self.data_packets[file] = data_packet
+            self._dirty.add(file)
 
+    def _openPacket(self, file):
+        try:
+            return file, DataPacket(source=file, lazy=self.lazy, append_only=self.append_only), None
+        except READ_ERRORS as e:
+            if not is_read_error(e):
+                raise
+            return file, None, e
+
+    @pyqtSlot(str)
     def _removeSource(self, file):
-        if file in self.data_packets:
+        if str(file) in self.data_packets:
             self.data_packets.pop(str(file))
+            self.snapshots.pop(str(file), None)
+            handle_pool.discard(file)
+        self._new.discard(str(file))
+        self._pending.discard(str(file))
+        self._failing.pop(str(file), None)
+
+    @pyqtSlot(str)
+    def _markDirty(self, file):
+        # Pending sources are retried by the next refresh once they changed
+        if str(file) in self.data_packets:
+            self._dirty.add(str(file))
+
+    @pyqtSlot(str)
+    def _onSourceAdded(self, file):
+        if self.check_source_folder:
+            self._new.add(str(file))
 
-    def _get_source_files(self, folder):
-        return [Path(folder) / str(f) for f in os.listdir(folder) if f.endswith(".h5") or f.endswith(".hdf5")]
+    def _watchSourceFolder(self):
+        if self.watcher is None:
+            self.watcher = SourceWatcher(self)
+            self.watcher.sourceAdded.connect(self._onSourceAdded)
+            self.watcher.sourceModified.connect(self._markDirty)
+            self.watcher.sourceRemoved.connect(self._removeSource)
+        self.watcher.watch(self.sourceFolder)
 
     def add_from_source_folder(self):
-        folder_files = self._get_source_files(self.sourceFolder)
-        for file in folder_files:
-            self._addSource(file)
+        # Picked up by the next refresh in the backend thread
+        self._rescan = True
 
+    @pyqtSlot()
     def updateData(self):
-        for packet in self.data_packets.values():
-            packet.update()
-        
-        if self.check_source_folder:
-            folder_files = self._get_source_files(DEFAULT_DIR)
-            for file in folder_files:
-                if file not in self.data_packets:
-                    self._addSource(file)   
+        if self._rescan:
+            self._rescan = False
+            self._watchSourceFolder()
+
+        now = time.monotonic()
+        poll_all = not (self.watcher.active and self._last_poll is not None
+                        and now - self._last_poll < WATCHED_POLL_INTERVAL)
+        if poll_all and self.check_source_folder:
+            # Without file system events, and now and then with them, poll
+            # everything. Unchanged files only cost a stat.
+            self.watcher.poll()
+
+        new, self._new = self._new, set()
+        new |= {source for source in self._pending if self._retryDue(source, now)}
+        self._addSources(sorted(new))
+
+        if poll_all:
+            sources = set(self.data_packets)
+            self._last_poll = now
+        else:
+            sources = self._dirty | (self.watcher.unwatched & set(self.data_packets))
+        self._dirty = set()
+        sources |= {source for source, packet in self.data_packets.items() if packet.snapshot_outdated}
+        sources |= set(self._failing) & set(self.data_packets)
+        sources = {source for source in sources if self._retryDue(source, now)}
+
+        dirty = {}
+        for source, changed, snapshot in self._executor.map(self._loadPacket, sources):
+            if changed is None and snapshot is None:
+                # Could not be read, retried once the file changes or later
+                self._failed(source, now)
+                continue
+            self._failing.pop(source, None)
+            if snapshot is not None:
+                self.snapshots[source] = snapshot
+                dirty[source] = None if changed is None else dirty_parts(changed)
+
+        if dirty:
+            self.dataReady.emit(dict(self.snapshots), dirty)
 
-        self.dataReady.emit()
+    def _loadPacket(self, source):
+        packet = self.data_packets[source]
+        try:
+            changed = packet.update() | packet.newly_wanted
+            if source not in self.snapshots:
+                # First snapshot of this source, everything is new
+                return source, None, packet.snapshot()
+            if not changed:
+                return source, changed, None
+            return source, changed, packet.snapshot()
+        except READ_ERRORS as e:
+            if not is_read_error(e):
+                raise
+            # Most likely caught mid-write, keep the last snapshot
+            if source not in self._failing:
+                print(f"Could not refresh {source}: {e}")
+            return source, None, None
+
+    def _failed(self, source, now = None):
+        now = time.monotonic() if now is None else now
+        state = file_state(source)
+        interval = RETRY_INTERVAL
+        previous = self._failing.get(source)
+        if previous is not None and previous[0] == state:
+            # Still broken and unchanged, wait longer
+            interval = min(previous[2] * 2, MAX_RETRY_INTERVAL)
+        self._failing[source] = (state, now + interval, interval)
+
+    def _retryDue(self, source, now):
+        failure = self._failing.get(source)
+        if failure is None:
+            return True
+        state, retry_at, _ = failure
+        return file_state(source) != state or now >= retry_at
 
     def extractLayout(self):
         '''
@@ -76,7 +353,30 @@ class CoreBackend(QObject):
             self.layoutReady.emit()
 
     def start(self):
-        self.timer.start(self.updateData)
+        self._startTimer.emit(self.timeout)
+
+    def stop(self):
+        self._stopTimer.emit()
+
+    def shutdown(self):
+        # Timers and watchers can only be stopped by the thread they live in
+        QMetaObject.invokeMethod(self, "_release", Qt.ConnectionType.BlockingQueuedConnection)
+        self._thread.quit()
+        self._thread.wait()
+        self._executor.shutdown()
+
+    @pyqtSlot()
+    def _release(self):
+        self.timer.stop()
+        if self.watcher is not None:
+            # Deleted by the backend thread when it finishes
+            self.watcher.setParent(None)
+            self.watcher.deleteLater()
+            self.watcher = None
+        # Pooled read handles would keep the files open after the backend is gone
+        handle_pool.close_all()
+        # The backend and its timer are destroyed from the main thread
+        self.moveToThread(QCoreApplication.instance().thread())
 
     @property
     def timeout(self):
@@ -85,6 +385,8 @@ class CoreBackend(QObject):
     @timeout.setter
     def timeout(self, value):
         self._timeout = value
+        if self.timer.isActive():
+            self._startTimer.emit(value)
         self.configChanged.emit()
 
     @property
@@ -96,7 +398,8 @@ class CoreBackend(QObject):
         self._check_source_folder = value
 
         if self._check_source_folder:
-            self.add_from_source_folder()
+            # Picked up by the next refresh in the backend thread
+            self._rescan = True
 
     @property
     def sourceFolder(self):
@@ -105,13 +408,43 @@ class CoreBackend(QObject):
     @sourceFolder.setter
     def sourceFolder(self, folder):
         self._sourceFolder = folder
+        self._rescan = True
+
+    @property
+    def lazy(self):
+        return self._lazy
+
+    @lazy.setter
+    def lazy(self, value):
+        self._lazy = value
+
+    @property
+    def append_only(self):
+        return self._append_only
+
+    @append_only.setter
+    def append_only(self, value):
+        self._append_only = value
+        for packet in list(self.data_packets.values()):
+            packet.append_only = value
+
+    @property
+    def cacheBudget(self):
+        return dataset_cache.max_bytes // 2**20
+
+    @cacheBudget.setter
+    def cacheBudget(self, value):
+        dataset_cache.max_bytes = value * 2**20
 
     @property
     def config(self) -> Dict[str, tuple[str, type]]:
         return {
             "Refresh interval": ("timeout", int),
             "Check source folder": ("check_source_folder", bool),
-            "Source folder": ("sourceFolder", str)
+            "Source folder": ("sourceFolder", str),
+            "Lazy loading": ("lazy", bool),
+            "Append-only files": ("append_only", bool),
+            "Cache budget (MB)": ("cacheBudget", int)
         }
 
     def set_config(self, values):
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+class AppendBuffer:
+    '''
+    Preallocated array that grows geometrically along its first axis, so that
+    appending n rows costs O(n) amortised instead of a copy of the whole array.
+    '''
+    GROWTH = 2
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self._size = values.shape[0]
+        self._array = np.empty((max(self._size, 1) * self.GROWTH,) + values.shape[1:],
+                               dtype=values.dtype)
+        self._array[:self._size] = values
+
+    def extend(self, values):
+        needed = self._size + values.shape[0]
+        if needed > self._array.shape[0]:
+            grown = np.empty((max(needed, self._array.shape[0] * self.GROWTH),) + self._array.shape[1:],
+                             dtype=self._array.dtype)
+            grown[:self._size] = self._array[:self._size]
+            self._array = grown
+        self._array[self._size:needed] = values
+        self._size = needed
+
+    @property
+    def view(self):
+        return self._array[:self._size]
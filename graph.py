@@ -186,15 +186,22 @@ class Graph(QDockWidget):
         self.penIndex += 1
         return pen
 
-    def updateData(self, data):
+    def updateData(self, data, parts = None):
+        maps_updated = False
         for part_name, plot in self.plots.items():
+            if parts is not None and part_name not in parts:
+                continue
             if part_name in data:
                 plot.updateData(data[part_name])
+                maps_updated = maps_updated or isinstance(plot, Map)
 
         if self._pending_lutRange_update and self.lut_item:
             self.lut_item.updateLUTRegion()
             self.lut_item.updateLUT()
             self._pending_lutRange_update = False
+        elif maps_updated and self.lut_item:
+            # Combines the histograms the maps keep up to date, no pixel is read
+            self.lut_item.updateHistogram()
 
     def addMarginals(self):
         layout = self.layout_widget.ci.layout
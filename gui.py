@@ -29,7 +29,7 @@ from PyQt6.QtWidgets import (
 )
 
 from backend import CoreBackend
-from plots import PlotWidget
+from plotwidget import PlotWidget
 
 left  = 0.125  # the left side of the subplots of the figure
 right = 0.9    # the right side of the subplots of the figure
@@ -181,11 +181,13 @@ class MainWindow(QMainWindow):
             self.plotWidget.setParent(None)
             self.plotWidget = None
 
-    def updateData(self):
+    def updateData(self, snapshots, dirty):
         self.led.setStyleSheet(self.led_on_style)
         QTimer.singleShot(1000, lambda: self.led.setStyleSheet(self.led_off_style))
         if self.plotWidget is not None:
-            self.plotWidget.updateData(self.backend.data_packets)
+            for source, graphs in dirty.items():
+                if source in snapshots:
+                    self.plotWidget.updateData(snapshots[source], dirty=graphs)
 
 
 # class ConfigDialog(QDialog):
@@ -3,10 +3,37 @@ import numpy as np
 import os
 
 from pathlib import Path
-from filelock import FileLock
+from filelock import FileLock, Timeout
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+
+from buffers import AppendBuffer
 
 DEFAULT_DIR = Path.home() / 'plot_data'
 
+# Dataset attribute bumped by writers whenever they rewrite values of an
+# existing dataset. Datasets without it are re-read whenever the file changes.
+GENERATION_ATTR = 'generation'
+
+# Memory budget shared by all lazily loaded datasets
+DEFAULT_CACHE_BYTES = 512 * 2**20
+
+# Number of HDF5 files kept open for reading between refreshes
+DEFAULT_MAX_HANDLES = 32
+
+# Seconds a reader waits for a writer holding the file lock before giving up
+# on the current refresh
+LOCK_TIMEOUT = 0.1
+
+# Rows per chunk of datasets created for streaming
+DEFAULT_CHUNK_ROWS = 1024
+
+# HDF5 superblock signature, and the consistency flag a version 3 superblock
+# carries while a writer has the file open in SWMR mode
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+SWMR_WRITE_FLAG = 0x04
+
 from zmq import (
     Context, Poller,
     SUB, PUB,
@@ -83,26 +110,426 @@ def load_data_from_hdf5(file_path):
         return _load_recursive(f)
 
 
+class DatasetCache:
+    '''
+    Least-recently-used store of dataset values bounded by their total size in bytes.
+    '''
+
+    def __init__(self, max_bytes = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = getattr(value, 'nbytes', 0)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._nbytes -= getattr(value, 'nbytes', 0)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+dataset_cache = DatasetCache()
+
+
+class LazyDataset:
+    '''
+    Placeholder for an HDF5 dataset that is read on first access and kept in
+    the shared dataset_cache afterwards.
+    '''
+
+    def __init__(self, file_path, name, shape, dtype, cache = None):
+        self.file_path = file_path
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.cache = cache if cache is not None else dataset_cache
+
+    @property
+    def key(self):
+        return (self.file_path, self.name)
+
+    def read(self):
+        value = self.cache.get(self.key)
+        if value is None:
+            with handle_pool.open(self.file_path) as f:
+                item = f[self.name]
+                if f.swmr_mode:
+                    item.refresh()
+                value = DataPacket._read_dataset(item)
+            self.cache.put(self.key, value)
+        return value
+
+
+class LazyGroup(Mapping):
+    '''
+    Read-only mapping over a lazily loaded HDF5 group. Subgroups are returned
+    as LazyGroup, datasets are read from disk when they are looked up.
+    '''
+
+    def __init__(self):
+        self.children = {}
+
+    def __getitem__(self, key):
+        value = self.children[key]
+        if isinstance(value, LazyDataset):
+            return value.read()
+        return value
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __contains__(self, key):
+        return key in self.children
+
+
+def _lock_path(file_path):
+    return Path(str(file_path) + ".lock")
+
+
+def _file_state_of(file_path):
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    st = os.stat(file_path)
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _swmr_writing(file_path):
+    """
+    True if a writer currently has the file open in SWMR mode, read from the
+    superblock. Only then may the file be read in SWMR mode: other files open
+    that way as well, but do not show later writes.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            # The superblock follows a user block of 0, 512, 1024, ... bytes
+            offset = 0
+            while True:
+                f.seek(offset)
+                head = f.read(12)
+                if len(head) < 12:
+                    return False
+                if head[:8] == HDF5_SIGNATURE:
+                    break
+                offset = offset * 2 if offset else 512
+    except OSError:
+        return False
+    # Byte 8 is the superblock version, byte 11 the file consistency flags
+    return head[8] >= 3 and bool(head[11] & SWMR_WRITE_FLAG)
+
+
+class _PooledHandle:
+    def __init__(self, file, state):
+        self.file = file
+        self.state = state
+        self.pins = 0
+        self.retired = False
+
+
+class HandlePool:
+    '''
+    Bounded pool of open HDF5 read handles keyed by path.
+
+    Files are opened with HDF5 file locking disabled, so that a pooled handle
+    never blocks a writer, and in SWMR read mode while an SWMR writer has them
+    open. A handle is reopened when its file was replaced or truncated and
+    whenever the file was modified, unless it is an SWMR handle and the file is
+    still written in SWMR mode: only those see later writes.
+    '''
+
+    def __init__(self, max_handles = DEFAULT_MAX_HANDLES):
+        self.max_handles = max_handles
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, file_path, file_state = None):
+        handle = self._acquire(str(file_path), file_state)
+        try:
+            yield handle.file
+        finally:
+            self._release(handle)
+
+    def discard(self, file_path):
+        with self._lock:
+            self._retire(str(file_path))
+
+    def close_all(self):
+        with self._lock:
+            for path in list(self._handles):
+                self._retire(path)
+
+    def _acquire(self, path, file_state):
+        state = file_state if file_state is not None else _file_state_of(path)
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is not None and self._is_stale(handle, state, path):
+                self._retire(path)
+                handle = None
+
+            if handle is None:
+                handle = self._handles[path] = _PooledHandle(self._open(path), state)
+                self._evict()
+            else:
+                handle.state = state
+                self._handles.move_to_end(path)
+
+            handle.pins += 1
+            return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.pins -= 1
+            if handle.retired and handle.pins == 0:
+                handle.file.close()
+
+    @staticmethod
+    def _open(path):
+        if _swmr_writing(path):
+            try:
+                return HandlePool._open_unlocked(path, libver='latest', swmr=True)
+            except (OSError, ValueError):
+                pass
+        return HandlePool._open_unlocked(path)
+
+    @staticmethod
+    def _open_unlocked(path, **kwargs):
+        try:
+            return h5py.File(path, 'r', locking=False, **kwargs)
+        except TypeError:
+            # h5py built against an HDF5 without the locking option
+            return h5py.File(path, 'r', **kwargs)
+        except OSError:
+            # The file is open for writing in this process, with its locking
+            # flags, and HDF5 shares that file between all handles
+            return h5py.File(path, 'r', **kwargs)
+
+    @staticmethod
+    def _is_stale(handle, state, path):
+        if not handle.file.id.valid:
+            return True
+        if state[:2] != handle.state[:2] or state[3] < handle.state[3]:
+            return True
+        if state == handle.state:
+            return False
+        return not (handle.file.swmr_mode and _swmr_writing(path))
+
+    def _retire(self, path):
+        handle = self._handles.pop(path, None)
+        if handle is None:
+            return
+        handle.retired = True
+        if handle.pins == 0:
+            handle.file.close()
+
+    def _evict(self):
+        for path in list(self._handles):
+            if len(self._handles) <= self.max_handles:
+                break
+            if self._handles[path].pins == 0:
+                self._retire(path)
+
+
+handle_pool = HandlePool()
+
+
+def _create_growing_dataset(group, name, row_shape, dtype, chunks = None, **kwargs):
+    row_shape = tuple(row_shape)
+    dataset = group.create_dataset(name,
+                                   shape=(0,) + row_shape,
+                                   maxshape=(None,) + row_shape,
+                                   dtype=dtype,
+                                   chunks=chunks or (DEFAULT_CHUNK_ROWS,) + row_shape,
+                                   **kwargs)
+    # Readers detect appended rows from the shape, the generation only moves
+    # when existing rows are rewritten
+    dataset.attrs[GENERATION_ATTR] = 0
+    return dataset
+
+
+def _append_rows(dataset, values):
+    values = np.asarray(values, dtype=dataset.dtype)
+    if values.ndim == dataset.ndim - 1:
+        values = values[np.newaxis]
+
+    old_len = dataset.shape[0]
+    dataset.resize(old_len + values.shape[0], axis=0)
+    dataset[old_len:] = values
+    return values, old_len
+
+
+class SWMRWriter:
+    '''
+    Streams data into an HDF5 file in single-writer/multiple-reader mode.
+
+    Datasets are created once, chunked and resizable along the first axis, and
+    then only grow through append(). Every append is flushed, so readers that
+    keep the file open (see HandlePool) see the new rows without any locking.
+    All datasets and metadata have to be declared before start() is called.
+    '''
+
+    def __init__(self, file_path, metadata = None):
+        self.file_path = Path(file_path)
+        if not os.path.exists(self.file_path.parent):
+            os.makedirs(self.file_path.parent)
+
+        self._file = h5py.File(self.file_path, 'w', libver='latest')
+        for key, value in (metadata or {}).items():
+            self._file.attrs[key] = value
+
+    def create_dataset(self, name, row_shape = (), dtype = np.float64, chunks = None, **kwargs):
+        """
+        Create an empty dataset that grows along its first axis.
+
+        Parameters:
+            name (str): HDF5 path of the dataset, intermediate groups are created.
+            row_shape (tuple): Shape of a single appended row.
+            dtype: Data type of the dataset.
+            chunks (tuple): Chunk shape, defaults to DEFAULT_CHUNK_ROWS rows.
+            **kwargs: Passed on to h5py, e.g. compression.
+        """
+        if self._file.swmr_mode:
+            raise RuntimeError("Datasets have to be created before start()")
+        return _create_growing_dataset(self._file, name, row_shape, dtype, chunks, **kwargs)
+
+    def start(self):
+        self._file.swmr_mode = True
+
+    def append(self, name, values):
+        dataset = self._file[name]
+        _append_rows(dataset, values)
+        dataset.flush()
+
+    def close(self):
+        if self._file.id.valid:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LazySnapshot(Mapping):
+    '''
+    Read-only view of a lazy group as it was when the snapshot was taken.
+
+    Looking up a dataset that is not loaded yet never touches the disk, it is
+    only marked as wanted so that the next snapshot of the packet contains it.
+    Until then it is missing from the snapshot: lookups raise KeyError, and
+    iteration and membership tests leave it out.
+    '''
+
+    def __init__(self, children, pending, wanted):
+        self._children = children
+        self._pending = pending
+        self._wanted = wanted
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._wanted.add(self._pending[key])
+            raise KeyError(key)
+        return self._children[key]
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __contains__(self, key):
+        return key in self._children
+
+
+def _same_metadata(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.keys() == b.keys() and all(np.array_equal(a[key], b[key]) for key in a)
+
+
+def _growable(item):
+    # Chunked and unlimited along the first axis, as append() creates datasets
+    return item.chunks is not None and bool(item.shape) and item.maxshape[0] is None
+
+
+def _frozen(value):
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
 class DataPacket:
     '''
     A class to handle data loading and saving operations.
     Supports only HDF5 format for now.
     '''
 
-    def __init__(self, data = None, source = None):
+    def __init__(self, data = None, source = None, lazy = False, dataset_options = None,
+                 append_only = False):
+        self.lazy = lazy
+        # Resizable datasets of the source are only ever appended to, even
+        # without a generation counter: a grown one is read as a tail, one with
+        # an unchanged shape is not read again. Fixed-shape datasets are still
+        # re-read whenever the file changes
+        self.append_only = append_only
+        # Per dataset path h5py creation options (chunks, compression, ...) used by append
+        self.dataset_options = dataset_options or {}
+        self._file_state = None
+        self._dataset_state = {}
+        self._buffers = {}
+        self._writer = None
+        # Lazy datasets that were looked up in a snapshot and are loaded for the next ones
+        self._wanted = set()
+        self._snapshot_wanted = set()
+        # Name -> (LazyDataset, value) of the wanted datasets in the last
+        # snapshot. Refreshes replace the LazyDataset of a changed dataset, the
+        # values of the others are handed out again without reading them.
+        self._snapshot_values = {}
+        # Names of arrays shared with snapshots, they are copied before a write
+        self._handed_out = set()
+
         if source and not data:
             self.load_data(source)
             self.source = Path(source)
-            self._lock = FileLock(self.source / ".lock")
 
         elif data:
             self.data = data
             self.source = source if source else Path(DEFAULT_DIR / str(id(self.data)))
-            self._lock = FileLock(self.source / ".lock")
+            self._lock = FileLock(_lock_path(self.source))
 
         else:
             self.data = data
             self.source = source
+            self._lock = None
 
     def setData(self, data):
         self.data = data
@@ -112,22 +539,114 @@ class DataPacket:
             self.source = Path(id(self.data))
 
     def update(self):
-        if self.source:
-            self.data = self._load_data_from_hdf5(self.source)
+        """
+        Refresh the packet from its source file.
+
+        Only datasets whose shape or generation counter changed since the last
+        refresh are read again, all other arrays in self.data are left in place.
+        Nothing is read when the file itself is unchanged.
+
+        Returns:
+            set: HDF5 names of the datasets that were (re)loaded or removed,
+                 plus "<group>/metadata" for groups whose attributes changed.
+        """
+        if not self.source:
+            return set()
+        return self._refresh_from_hdf5(self.source)
+
+    def snapshot(self):
+        """
+        Immutable copy of the current data that can be handed to another thread.
+
+        Arrays are shared as read-only views, the refresh never writes into an
+        array it already handed out. For lazy packets the datasets looked up in
+        earlier snapshots are read here, in the calling thread, unless they are
+        unchanged since the last snapshot.
+
+        Returns:
+            Mapping: Nested dicts (LazySnapshot for lazy packets) of the data.
+        """
+        if self.data is None:
+            return {}
+        self._snapshot_wanted = set(self._wanted)
+        values, self._snapshot_values = self._snapshot_values, {}
+        return self._snapshot(self.data, previous=values)
+
+    @property
+    def newly_wanted(self):
+        """
+        Lazy datasets that were asked for in a snapshot but are missing from the last one.
+        """
+        # Copy first, snapshots add to the set from the GUI thread
+        return set(self._wanted) - self._snapshot_wanted
+
+    @property
+    def snapshot_outdated(self):
+        return bool(self.newly_wanted)
 
     def load_data(self, source, format = "hdf5"):
         if format == "hdf5":
-            self.data = self._load_data_from_hdf5(source)
+            self._file_state = None
+            self._dataset_state = {}
+            self._buffers = {}
+            self.data = self._empty_data()
+            self._lock = FileLock(_lock_path(source))
+            self._refresh_from_hdf5(source)
             self.source = source
         else:
             raise ValueError(f"Unsupported format: {format}")
 
     def save_data(self, format = "hdf5"):
         if format == "hdf5":
-            self._save_data_to_hdf5(self.source, self.data)
+            self.close()
+            # HDF5 refuses to truncate a file that this process has open read-only
+            handle_pool.discard(self.source)
+            with self._lock:
+                self._save_data_to_hdf5(self.source, self.data)
         else:
             raise ValueError(f"Unsupported format: {format}")
 
+    def append(self, path, values):
+        """
+        Append rows to a dataset, writing only the new rows to disk.
+
+        A missing dataset is created chunked and resizable along its first axis
+        with the options configured for it in dataset_options. The file stays
+        open for further writes until close() is called.
+
+        Parameters:
+            path (str): Dataset path inside the file, e.g. "Plot1/signal/y".
+            values (np.ndarray): Rows to append, or a single row.
+        """
+        with self._lock:
+            f = self._open_writer()
+            dataset = self._growing_dataset(f, path, values)
+            values, old_len = _append_rows(dataset, values)
+            f.flush()
+            self._store_appended(dataset, values, old_len)
+
+    def update_slice(self, path, index, values):
+        """
+        Overwrite a region of an existing dataset in place.
+
+        Parameters:
+            path (str): Dataset path inside the file, e.g. "Plot2/map/z".
+            index: Any numpy/h5py index selecting the region, e.g. np.s_[3, :].
+            values (np.ndarray): New values for the region.
+        """
+        with self._lock:
+            f = self._open_writer()
+            dataset = f[path]
+            dataset[index] = values
+            dataset.attrs[GENERATION_ATTR] = dataset.attrs.get(GENERATION_ATTR, 0) + 1
+            f.flush()
+            self._store_patched(dataset, index, values)
+
+    def close(self):
+        if self._writer is not None and self._writer.id.valid:
+            self._writer.close()
+        self._writer = None
+
     def __getitem__(self, key):
         if not self.data:
             raise Warning("No data loaded")
@@ -139,6 +658,257 @@ class DataPacket:
             raise Warning("No data loaded")
         return tuple(self.data.keys())
 
+    def _snapshot(self, data, name = '', previous = None):
+        if isinstance(data, LazyGroup):
+            children, pending = {}, {}
+            for key, value in data.children.items():
+                if not isinstance(value, LazyDataset):
+                    children[key] = self._snapshot(value, f"{name}/{key}", previous)
+                elif value.name in self._wanted:
+                    dataset, loaded = previous.get(value.name, (None, None))
+                    if dataset is not value:
+                        loaded = _frozen(value.read())
+                    self._snapshot_values[value.name] = (value, loaded)
+                    children[key] = loaded
+                else:
+                    pending[key] = value.name
+            return LazySnapshot(children, pending, self._wanted)
+
+        if isinstance(data, dict):
+            return {key: self._snapshot(value, f"{name}/{key}", previous)
+                    for key, value in data.items()}
+        if isinstance(data, np.ndarray):
+            self._handed_out.add(name)
+        return _frozen(data)
+
+    @staticmethod
+    def _dataset_state_of(item):
+        return item.shape, item.attrs.get(GENERATION_ATTR, None)
+
+    @staticmethod
+    def _read_dataset(item):
+        value = item[()]
+        if isinstance(value, bytes):
+            return str(value.decode('utf-8'))
+        return value
+
+    def _refresh_from_hdf5(self, file_path):
+        file_state = _file_state_of(file_path)
+        if file_state == self._file_state:
+            return set()
+
+        changed = set()
+        try:
+            lock = self._read_lock(file_path)
+            if self._writer is not None:
+                handle = nullcontext(self._writer)
+            else:
+                handle = handle_pool.open(file_path, file_state)
+
+            with lock, handle as f:
+                # A replaced (new inode) or truncated file invalidates everything we know
+                if (self._file_state is None
+                        or file_state[:2] != self._file_state[:2]
+                        or file_state[3] < self._file_state[3]):
+                    self._dataset_state = {}
+                    self._buffers = {}
+                    self.data = self._empty_data()
+
+                self._refresh_group(f, self._children(self.data), changed)
+        except Timeout:
+            # The writer is busy, try again on the next refresh
+            return changed
+        self._file_state = file_state
+        return changed
+
+    def _read_lock(self, file_path):
+        """
+        Lock to hold while reading. SWMR files are read lock-free, others wait
+        for a DataPacket writing them, which leaves its lock file next to the
+        data file. Readers never create lock files, so files of other writers
+        and read-only folders are read without one.
+        """
+        if (self._lock is None or _swmr_writing(file_path)
+                or not os.path.exists(self._lock.lock_file)):
+            return nullcontext()
+        try:
+            return self._lock.acquire(timeout=LOCK_TIMEOUT)
+        except PermissionError:
+            return nullcontext()
+
+    def _empty_data(self):
+        return LazyGroup() if self.lazy else {}
+
+    @staticmethod
+    def _children(data):
+        return data.children if isinstance(data, LazyGroup) else data
+
+    def _refresh_group(self, group, data, changed):
+        for key in list(data.keys()):
+            if key != 'metadata' and key not in group:
+                removed = data.pop(key)
+                name = f"{group.name.rstrip('/')}/{key}"
+                changed.add(name)
+                self._forget(name, removed)
+
+        for key in group.keys():
+            item = group[key]
+            if isinstance(item, h5py.Group):
+                if not isinstance(data.get(str(key)), (dict, LazyGroup)):
+                    data[str(key)] = self._empty_data()
+                self._refresh_group(item, self._children(data[str(key)]), changed)
+                continue
+
+            if item.file.swmr_mode:
+                item.refresh()
+            state = self._dataset_state_of(item)
+            previous = self._dataset_state.get(item.name)
+            tracked = state[1] is not None or (self.append_only and _growable(item))
+            if tracked and state == previous and str(key) in data:
+                continue
+
+            if self.lazy:
+                dataset_cache.discard((item.file.filename, item.name))
+                data[str(key)] = LazyDataset(item.file.filename, item.name, item.shape, item.dtype)
+            elif str(key) in data and self._is_appended(item, previous, state):
+                data[str(key)] = self._read_tail(item, previous[0][0], data[str(key)])
+            else:
+                self._buffers.pop(item.name, None)
+                data[str(key)] = self._read_dataset(item)
+            self._dataset_state[item.name] = state
+            changed.add(item.name)
+
+        previous = data.pop('metadata', None)
+        if group.attrs:
+            data['metadata'] = {}
+            for attr in group.attrs:
+                data['metadata'][attr] = group.attrs[attr]
+        if not _same_metadata(previous, data.get('metadata')):
+            changed.add(f"{group.name.rstrip('/')}/metadata")
+
+    def _open_writer(self):
+        if self._writer is None:
+            if not os.path.exists(os.path.dirname(self.source)):
+                os.makedirs(os.path.dirname(self.source))
+            # HDF5 refuses to open a file for writing that this process has open read-only
+            handle_pool.discard(self.source)
+            self._writer = h5py.File(self.source, 'a')
+        return self._writer
+
+    def _growing_dataset(self, f, path, values):
+        existing = None
+        if path in f:
+            dataset = f[path]
+            if dataset.chunks is not None and dataset.maxshape[0] is None:
+                return dataset
+            # Written by a full save, convert it once into a resizable dataset
+            existing = dataset[()]
+            del f[path]
+
+        if existing is not None:
+            row_shape, dtype = existing.shape[1:], existing.dtype
+        else:
+            values = np.asarray(values)
+            row_shape, dtype = values.shape[1:], values.dtype
+
+        options = dict(self.dataset_options.get(path.strip('/'), {}))
+        dataset = _create_growing_dataset(f, path, row_shape, dtype, **options)
+        if existing is not None:
+            _append_rows(dataset, existing)
+        return dataset
+
+    def _parent_of(self, name):
+        if self.data is None:
+            self.data = self._empty_data()
+
+        *groups, key = name.strip('/').split('/')
+        parent = self._children(self.data)
+        for group in groups:
+            if not isinstance(parent.get(group), (dict, LazyGroup)):
+                parent[group] = self._empty_data()
+            parent = self._children(parent[group])
+        return parent, key
+
+    def _store_appended(self, dataset, values, old_len):
+        parent, key = self._parent_of(dataset.name)
+        if self.lazy:
+            self._store_lazy(parent, key, dataset)
+        else:
+            buffer = self._buffers.get(dataset.name)
+            if buffer is None or buffer.view.shape[0] != old_len:
+                current = parent.get(key)
+                if current is None or np.shape(current)[:1] != (old_len,):
+                    current = dataset[:old_len]
+                buffer = self._buffers[dataset.name] = AppendBuffer(current)
+            buffer.extend(values)
+            parent[key] = buffer.view
+        self._wrote(dataset)
+
+    def _store_patched(self, dataset, index, values):
+        parent, key = self._parent_of(dataset.name)
+        if self.lazy:
+            self._store_lazy(parent, key, dataset)
+        elif isinstance(parent.get(key), np.ndarray) and parent[key].shape == dataset.shape:
+            if dataset.name in self._handed_out:
+                # A snapshot shares the array, write into a copy of it
+                self._handed_out.discard(dataset.name)
+                self._buffers.pop(dataset.name, None)
+                parent[key] = parent[key].copy()
+            parent[key][index] = values
+        else:
+            parent[key] = self._read_dataset(dataset)
+        self._wrote(dataset)
+
+    @staticmethod
+    def _store_lazy(parent, key, dataset):
+        dataset_cache.discard((dataset.file.filename, dataset.name))
+        parent[key] = LazyDataset(dataset.file.filename, dataset.name, dataset.shape, dataset.dtype)
+
+    def _wrote(self, dataset):
+        # Our own writes must not look like outside changes to the next update()
+        self._dataset_state[dataset.name] = self._dataset_state_of(dataset)
+        self._file_state = _file_state_of(self.source)
+
+    def _is_appended(self, item, previous, state):
+        """
+        A dataset only grew along its first axis if it is resizable there, its
+        trailing dimensions are unchanged and no writer rewrote existing values.
+        Without a generation counter rewrites cannot be told apart, so untracked
+        datasets are only read as a tail for append_only packets, and only if
+        they are unlimited along the first axis.
+        """
+        if previous is None or not item.shape:
+            return False
+        (old_shape, old_generation), (new_shape, new_generation) = previous, state
+        grew = (len(new_shape) == len(old_shape)
+                and new_shape[1:] == old_shape[1:]
+                and new_shape[0] > old_shape[0])
+        if not grew or new_generation != old_generation:
+            return False
+        if self.append_only and _growable(item):
+            return True
+        resizable = (item.chunks is not None
+                     and (item.maxshape[0] is None or item.maxshape[0] > old_shape[0]))
+        return resizable and new_generation is not None
+
+    def _read_tail(self, item, old_len, current):
+        buffer = self._buffers.get(item.name)
+        if buffer is None:
+            buffer = self._buffers[item.name] = AppendBuffer(current)
+        buffer.extend(item[old_len:item.shape[0]])
+        return buffer.view
+
+    def _forget(self, name, removed):
+        self._dataset_state.pop(name, None)
+        self._buffers.pop(name, None)
+        if isinstance(removed, LazyDataset):
+            dataset_cache.discard(removed.key)
+        removed = self._children(removed)
+        if isinstance(removed, dict):
+            for key, value in removed.items():
+                if key != 'metadata':
+                    self._forget(f"{name}/{key}", value)
+
     @classmethod
     def _load_data_from_hdf5(cls, file_path, _layer = 0, _name = None):
         """
@@ -189,7 +959,7 @@ class DataPacket:
                 os.makedirs(os.path.dirname(file_path))
 
             with h5py.File(file_path, 'w') as f:
-                cls._save_data_to_hdf5(f, data)
+                cls._save_data_to_hdf5(f, data, _layer+1)
             return
 
         for key, value in data.items():
@@ -200,7 +970,7 @@ class DataPacket:
 
             elif isinstance(value, dict):
                 subgroup = file_path.create_group(key)
-                cls._save_data_to_hdf5(subgroup, value)
+                cls._save_data_to_hdf5(subgroup, value, _layer+1)
 
             elif isinstance(value, str):
                 file_path.create_dataset(key, data=np.bytes_(value, 'utf-8'))
@@ -1,4 +1,5 @@
 import sys
+import argparse
 import zmq
 from IPython.display import display
 from matplotlib import pyplot as plt
@@ -16,18 +17,30 @@ import sys
 import pyqtgraph as pg
 from PyQt6 import QtCore, QtWidgets, QtGui
 from PyQt6.QtCore import Qt, QObject, QThread, pyqtSignal as Signal, pyqtSlot as Slot, QTimer
-from PyQt6.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QStyle, QGridLayout, QProgressBar, QDockWidget, QFormLayout, QLabel, QLineEdit, QStatusBar, QToolBar
+from PyQt6.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QStyle, QGridLayout, QProgressBar, QDockWidget, QFormLayout, QLabel, QLineEdit, QStatusBar, QToolBar, QTabWidget
 from PyQt6.QtGui import QIcon, QAction
 from time import sleep
 from threading import Thread
+import threading
 import numpy as np
 from cmap import Colormap
 
 from live_plot_classes import *
+from plotwidget import PlotWidget
+from live_protocol import recv_data, SessionDecoder, Conflator
 
 DATA_PORT = 5555
 CONTROL_PORT = 5556
 
+# Poll timeout of the receiver thread in ms, bounds how long stop() waits
+RECEIVER_POLL_MS = 100
+
+# Frames queued by ZMQ before dropping, the receiver drains and conflates them
+RECEIVER_HWM = 1000
+
+# Seconds without frames after which the ack socket to a producer is closed
+ACK_IDLE_TIMEOUT = 10.0
+
 pg.setConfigOption('background', 0.9)
 pg.setConfigOption('foreground', 'k')
 
@@ -40,51 +53,163 @@ hspace = 0.2   # the amount of height reserved for white space between subplots
 
 
 
-class MainWindow(QMainWindow):
-
-    colors = []
-    cmap = pg.colormap.get('CET-D1A')
-    #colormap = pg.colormap.get('viridis', source='matplotlib')  # Use any colormap you like
-    for i in range(4):
-        color = cmap.map(i/4, 'qcolor')
-        colors.append(color)
+class ReceiverThread(QThread):
+    '''
+    Drains the SUB socket continuously and decodes the session protocol off the
+    GUI thread. Frames of every stream (topic) are merged by a Conflator until
+    the GUI, notified with frameReady, collects them with takeFrames.
+
+    A single socket serves all producers: it connects to every endpoint in
+    connect and binds every endpoint in bind, so producers started later can
+    connect their PUB sockets to it. Each producer publishes under its own topic.
+
+    Producers that advertise an ack address in their frames (see
+    publisher.Publisher) get the number of frames received sent back to it
+    after every drained batch, which is the credit their send rate follows.
+    Shared memory rings and ack sockets are released once no stream uses them
+    any more.
+    '''
+    frameReady = Signal()
+
+    def __init__(self, connect = (), bind = (), parent = None):
+        super().__init__(parent)
+        self.connect_endpoints = list(connect or ())
+        self.bind_endpoints = list(bind or ())
+        self._lock = threading.Lock()
+        self._conflators = {}
+        self._sessions = {}
+        self._acks = {}
+        self._ackSockets = {}
+        # Ack address -> time of the last frame asking for acknowledgement
+        self._ackUsed = {}
+        # Shared memory rings of same-host producers, attached on first use,
+        # and the ring each topic currently sends through
+        self._rings = {}
+        self._topicRings = {}
+        self._running = True
+
+    def run(self):
+        # ZMQ sockets are not thread safe, the socket lives in this thread only
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, RECEIVER_HWM)
+        for endpoint in self.bind_endpoints:
+            socket.bind(endpoint)
+        for endpoint in self.connect_endpoints:
+            socket.connect(endpoint)
+        socket.setsockopt_string(zmq.SUBSCRIBE, '')  # Subscribe to all topics
+
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
 
-    penRotation = [pg.mkPen(color = c, width = 3) for c in colors]
+        try:
+            while self._running:
+                if not poller.poll(RECEIVER_POLL_MS):
+                    continue
+
+                received = False
+                while True:
+                    try:
+                        topic, header, data = recv_data(socket, flags=zmq.NOBLOCK, rings=self._rings)
+                    except zmq.Again:
+                        break
+                    received = self._receive(topic, header, data) or received
+
+                self._sendAcks()
+                self._releaseUnused()
+                if received:
+                    self.frameReady.emit()
+        finally:
+            socket.close(linger=0)
+            for ack_socket in self._ackSockets.values():
+                ack_socket.close(linger=0)
+            for ring in self._rings.values():
+                ring.close()
+
+    def _sendAcks(self):
+        for (address, topic), count in self._acks.items():
+            ack_socket = self._ackSockets.get(address)
+            if ack_socket is None:
+                ack_socket = zmq.Context.instance().socket(zmq.PUSH)
+                ack_socket.connect(address)
+                self._ackSockets[address] = ack_socket
+            try:
+                ack_socket.send_multipart([topic, str(count).encode()], flags=zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # Producer gone or not reachable, it falls back to its slowest rate
+        self._acks = {}
+
+    def _releaseUnused(self):
+        # Rings of restarted or closed producers, and of frames that went stale
+        in_use = set(self._topicRings.values())
+        for name in list(self._rings):
+            if name not in in_use or self._rings[name].closed:
+                self._rings.pop(name).close()
+                self._topicRings = {topic: ring for topic, ring in self._topicRings.items()
+                                    if ring != name}
+
+        now = time.monotonic()
+        for address in list(self._ackSockets):
+            if now - self._ackUsed.get(address, 0) > ACK_IDLE_TIMEOUT:
+                self._ackSockets.pop(address).close(linger=0)
+                self._ackUsed.pop(address, None)
+
+    def _receive(self, topic, header, data):
+        self._topicRings[topic] = header.get('ring')
+        address = header.get('ack')
+        if address is not None:
+            self._acks[(address, topic)] = self._acks.get((address, topic), 0) + 1
+            self._ackUsed[address] = time.monotonic()
+
+        session = self._sessions.setdefault(topic, SessionDecoder())
+        layout_changed, data = session.decode(header, data)
+        if data is None:
+            return False  # Layout not known yet, wait for the next key frame
+
+        with self._lock:
+            conflator = self._conflators.setdefault(topic, Conflator())
+            conflator.push(layout_changed, session.layout, data, session.session)
+        return True
+
+    def takeFrames(self):
+        """
+        Collect the frames received since the last call.
+
+        Returns:
+            dict: topic -> (layout_changed, layout, data)
+        """
+        with self._lock:
+            frames = {topic: conflator.take() for topic, conflator in self._conflators.items()}
+        return {topic: frame for topic, frame in frames.items() if frame is not None}
+
+    def stop(self):
+        self._running = False
+        self.wait()
 
-    currentPens = {}
 
-    cmap = pg.colormap.get('CET-L12')
+class MainWindow(QMainWindow):
+    '''
+    Shows every live stream in its own PlotWidget tab, keyed by ZMQ topic.
+    '''
 
-    def __init__(self, zmq_socket):
+    def __init__(self, receiver):
         super().__init__()
-
-        self.thread = QThread()
-
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.updatePlots)
-
-        self.layout = None
-
-        self.zmq_socket = zmq_socket
-
-        self.poller = zmq.Poller()
-        self.poller.register(self.zmq_socket, zmq.POLLIN)
-        #self._createLayout(self.layout)
-
-    def _createLayout(self, data_pack):
         self.setWindowTitle("Measurement Live Plot")
         self.resize(1400, 1200)
 
-        self.layout = data_pack['layout']
-        plotLayout = QGridLayout()
-        self.main_widget = QWidget()
-        self.setCentralWidget(self.main_widget)
+        self.live = True
+        # topic -> layout and PlotWidget of the stream
+        self.layouts = {}
         self.plotWidgets = {}
 
-        verticalLayout = QVBoxLayout()
-        horizontalLayout = QHBoxLayout()
+        self.tabs = QTabWidget()
+        self.setCentralWidget(self.tabs)
+        self._createToolbar()
 
+        # Frames arrive from the receiver thread, the GUI thread never polls
+        self.receiver = receiver
+        self.receiver.frameReady.connect(self.updatePlots)
 
+    def _createToolbar(self):
         self.toolbar = QToolBar("Main Toolbar")
         self.addToolBar(Qt.ToolBarArea.TopToolBarArea, self.toolbar)
 
@@ -118,107 +243,39 @@ class MainWindow(QMainWindow):
         self.redock_action.triggered.connect(self._redockAll)
         self.toolbar.addAction(self.redock_action)
 
+        self._start()
 
+    def _createStream(self, topic, layout, data):
+        plot_widget = PlotWidget(layout=layout, metadata=data.get('metadata', None))
+        n_iterations = data.get("n_iterations", 1_000_000)
+        plot_widget.progressBar.setMaximum(n_iterations)
 
+        title = topic.decode('utf-8', 'replace') or "Live"
+        old_widget = self.plotWidgets.get(topic)
+        if old_widget is None:
+            self.tabs.addTab(plot_widget, title)
+        else:
+            index = self.tabs.indexOf(old_widget)
+            self.tabs.removeTab(index)
+            self.tabs.insertTab(index, plot_widget, title)
+            old_widget.deleteLater()
 
-
-
-        #self._stopData()
-
-
-
-        # horizontalLayout.addWidget(self.startButton)
-        # horizontalLayout.addWidget(self.stopButton)
-        # horizontalLayout.addWidget(self.saveButton)
-        # horizontalLayout.addWidget(self.redockButton)
-        # horizontalLayout.addWidget(self.stopDataButton)
-
-
-        self.plotItems = {}
-
-        self.lineEdits = {}
-        metaData = data_pack.get('metadata', None)
-
-        if metaData is not None:
-            metadataWidget = QWidget()
-            metadataLayout = QFormLayout()
-
-            for attribute, value in metaData.items():
-                line_edit = QLineEdit(value)
-                metadataLayout.addRow(QLabel(attribute), line_edit)
-                self.lineEdits[attribute] = line_edit
-
-            metadataWidget.setLayout(metadataLayout)
-
-            #horizontalLayout.addWidget(metadataWidget)
-
-        horizontalWidget = QWidget()
-        horizontalWidget.setLayout(horizontalLayout)
-
-        for key, value in self.layout.items():
-            self.plotWidgets[key] = GraphCreator(self, key, value)
-
-            plotLayout.addWidget(self.plotWidgets[key],#dockWidget,
-                                 self.layout[key]['loc'][0],
-                                 self.layout[key]['loc'][1],
-                                 self.layout[key]['loc'][2],
-                                 self.layout[key]['loc'][3])
-
-
-        plotWidget = QWidget()
-        plotWidget.setLayout(plotLayout)
-
-
-        ### Set the progress bar
-        self.progressBar = QProgressBar(self)
-        self.progressBar.setValue(0)
-
-        self.progressBar.setMaximum(data_pack.get("n_iterations", 1_000_000))
-        self.progressBar.setFormat("{}/{}".format(0,data_pack.get("n_iterations", 1_000_000)))
-
-        self.status_bar = QStatusBar()
-        self.setStatusBar(self.status_bar)
-        self.status_bar.addPermanentWidget(self.progressBar, stretch=1)
-
-        #verticalLayout.addWidget(self.progressBar)
-        verticalLayout.addWidget(horizontalWidget)
-        verticalLayout.addWidget(plotWidget)
-
-
-        self.main_widget.setLayout(verticalLayout)
-
-        try:
-            self._stop()
-        except:
-            pass
-
-        try:
-            self._start()
-        except:
-            pass
+        self.layouts[topic] = layout
+        self.plotWidgets[topic] = plot_widget
 
     def _redockAll(self):
-        self.main_widget.setParent(None)
-        self._createLayout(self.data)
-        self._start()
-
-    def updateProgress(self, v):
-        self.progressBar.setValue(v)
+        for plot_widget in self.plotWidgets.values():
+            plot_widget.restore_layout_state(plot_widget._initial_state)
 
     def _start(self):
-        self.timer.start(400)
-        self.startButton.setEnabled(False)
-        self.stopButton.setEnabled(True)
+        self.live = True
+        self.start_action.setEnabled(False)
+        self.stop_action.setEnabled(True)
 
     def _stop(self):
-        self.timer.stop()
-        self.startButton.setEnabled(True)
-        self.stopButton.setEnabled(False)
-
-    def _stopData(self):
-        self.startButton.setEnabled(False)
-        self.stopButton.setEnabled(False)
-        self.stopDataButton.setEnabled(False)
+        self.live = False
+        self.start_action.setEnabled(True)
+        self.stop_action.setEnabled(False)
 
     def _save(self):
         # Start a new thread for the save operation
@@ -244,66 +301,57 @@ class MainWindow(QMainWindow):
             thread_socket.close()
             thread_context.term()
 
-
-
-
     def updatePlots(self):
-        events = dict(self.poller.poll(100))  # Poll sockets with a 100-ms timeout
-        if self.zmq_socket in events:
-            try:
-                data = self.zmq_socket.recv_pyobj(flags=zmq.NOBLOCK)
-                self.data = data
-            except zmq.Again as e:
-                return None  # No data received
-
-        else:
-            return None
-
-        if self.layout == None:
-            try:
-                self.layout = data["layout"]
-            except:
-                return None
-
-            self._createLayout(data)
-
-        elif self.layout != data["layout"]:
-            self.main_widget.setParent(None)
-            self.layout = data["layout"]
-            self._createLayout(data)
+        if not self.live:
+            return None  # Paused, the receiver keeps merging frames
 
+        # One batch for all streams, however many producers are connected
+        for topic, (layout_changed, layout, data) in self.receiver.takeFrames().items():
+            self._showFrame(topic, layout_changed, layout, data)
 
+    def _showFrame(self, topic, layout_changed, layout, data):
+        # Widgets are only rebuilt when the layout hash of the stream changes
+        if layout_changed or topic not in self.plotWidgets:
+            self._createStream(topic, layout, data)
 
-        self.progressBar.setValue(data.get("iter", 0)+1)
-        self.progressBar.setFormat("{}/{}".format(data.get("iter", 0),
-                                                  data.get("n_iterations", 1_000_000)))
+        data_pack = dict(data["data"])
+        # Frames only carry the parts that changed
+        dirty = {key: set(parts) for key, parts in data["data"].items()}
+        for key in ("iter", "n_iterations", "metadata"):
+            if key in data:
+                data_pack[key] = data[key]
+                dirty[key] = None
 
-        metaData = data.get('metadata', None)
+        self.plotWidgets[topic].updateData(data_pack, dirty=dirty)
 
-        if metaData is not None:
-            for attribute, value in metaData.items():
-                self.lineEdits[attribute].setText(value)
 
-        for key, value in self.layout.items():
-            self.plotWidgets[key].updateData(data["data"].get(key,{}))
-
-
-def main():
-    zmq_context = zmq.Context()
-    zmq_socket = zmq_context.socket(zmq.SUB)
-    zmq_socket.setsockopt(zmq.RCVHWM, 1)  # Set high-water mark to 1
-
-    zmq_socket.connect(f"tcp://localhost:{DATA_PORT}")
-    zmq_socket.setsockopt_string(zmq.SUBSCRIBE, '')  # Subscribe to all topics
+def main(connect = None, bind = None):
+    """
+    Start the live viewer.
 
+    Parameters:
+        connect (list): Producer endpoints to connect to.
+        bind (list): Endpoints to bind, producers connect their PUB sockets to them.
+    """
+    if not connect and not bind:
+        connect = [f"tcp://localhost:{DATA_PORT}"]
 
     app = QApplication(sys.argv)
 
-    main_window = MainWindow(zmq_socket)
+    receiver = ReceiverThread(connect=connect, bind=bind)
+    app.aboutToQuit.connect(receiver.stop)
+
+    main_window = MainWindow(receiver)
     main_window.show()
-    main_window.timer.start(400)
+    receiver.start()
 
     sys.exit(app.exec())
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Live plot of measurement streams")
+    parser.add_argument("--connect", action="append", default=[],
+                        help="producer endpoint to connect to, may be repeated")
+    parser.add_argument("--bind", action="append", default=[],
+                        help="endpoint producers connect to, may be repeated")
+    arguments = parser.parse_args()
+    main(arguments.connect, arguments.bind)
@@ -0,0 +1,587 @@
+import json
+import time
+import uuid
+import hashlib
+import numpy as np
+from collections.abc import Mapping
+from multiprocessing import shared_memory, resource_tracker
+
+from buffers import AppendBuffer
+
+# Key marking an array placeholder in the JSON header of a live frame
+ARRAY_KEY = '__array__'
+
+# Key marking an array placeholder whose data lives in a SharedRing
+SHM_KEY = '__shm__'
+
+# Arrays smaller than this are sent over ZMQ even when a SharedRing is used
+SHM_MIN_BYTES = 64 * 2**10
+
+# Bytes in front of the ring data (write position and capacity) and the
+# alignment of arrays in the ring
+SHM_HEADER = 64
+SHM_ALIGN = 64
+
+# Frame kinds of the session protocol
+LAYOUT_FRAME = 'layout'
+DATA_FRAME = 'data'
+
+# Seconds between key frames (layout and all parts), so late subscribers catch up
+KEYFRAME_INTERVAL = 2.0
+
+# Part config value marking a part whose frames only carry the newly added points
+APPEND_MODE = 'append'
+
+# HeatMap part keys patching the image in place (see plots.Map.updateData)
+PATCH_KEYS = ('z_rows', 'z_cols', 'z_region')
+
+# HeatMap part key holding a list of patches, applied in order
+PATCHES_KEY = 'z_patches'
+
+
+class StaleFrame(Exception):
+    '''
+    Raised when the shared memory of a frame was overwritten before it was read.
+    '''
+
+
+# Names of the rings created by this process, a viewer may run in it as well
+_created_rings = set()
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with the resource
+        # tracker, which would unlink it when this process exits. Segments
+        # this process created stay registered, they are unlinked on close.
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created_rings:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedRing:
+    '''
+    Ring buffer of array data in a shared memory segment, for producers and
+    viewers on the same host.
+
+    The producer copies each large array of a frame into the ring once, the
+    frame itself only carries its position. A position encodes how often the
+    ring had wrapped. The producer reserves a region by advancing the write
+    position before it copies into it, and the viewer copies an array out and
+    then checks that the write position did not reach it in the meantime, so
+    an array that was overwritten before or while it was read raises
+    StaleFrame instead of showing newer data. Closing the producer's ring
+    marks it closed, so viewers can release their mapping.
+    '''
+
+    def __init__(self, name = None, size = 0, create = False):
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SHM_HEADER + size)
+            _created_rings.add(self.shm.name)
+        else:
+            self.shm = _attach_shared_memory(name)
+        self.name = self.shm.name
+        self.owner = create
+
+        # [bytes written in total, capacity, closed by the producer]
+        self._header = np.ndarray((3,), dtype=np.uint64, buffer=self.shm.buf)
+        if create:
+            self._header[:] = (0, size, 0)
+        self.capacity = int(self._header[1])
+
+    @property
+    def written(self):
+        return int(self._header[0])
+
+    @property
+    def closed(self):
+        return self._header is None or bool(self._header[2])
+
+    def put(self, array):
+        """
+        Copy an array into the ring.
+
+        Returns:
+            int: Position of the array, or None if it does not fit into the ring.
+        """
+        nbytes = array.nbytes
+        if nbytes > self.capacity:
+            return None
+
+        position = self.written
+        offset = position % self.capacity
+        if offset + nbytes > self.capacity:
+            # Arrays are never split, skip the rest of the ring
+            position += self.capacity - offset
+            offset = 0
+
+        # Reserve the region first, readers of the data it overwrites see it
+        self._header[0] = position + -(-max(nbytes, 1) // SHM_ALIGN) * SHM_ALIGN
+        target = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf,
+                            offset=SHM_HEADER + offset)
+        target[...] = array
+        return position
+
+    def get(self, position, dtype, shape):
+        """
+        Copy an array out of the ring. Raises StaleFrame if the producer
+        overwrote it before or while it was copied.
+        """
+        self._check(position)
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf,
+                          offset=SHM_HEADER + position % self.capacity)
+        array = view.copy()
+        del view
+        self._check(position)
+        array.flags.writeable = False
+        return array
+
+    def _check(self, position):
+        if self.written > position + self.capacity:
+            raise StaleFrame(f"Array at {position} in {self.name} was overwritten")
+
+    def close(self):
+        if self._header is None:
+            return
+        if self.owner:
+            self._header[2] = 1
+        self._header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # Arrays still map the segment, it is released with them
+        if self.owner:
+            self.shm.unlink()
+            _created_rings.discard(self.name)
+
+
+def _encode_tree(value, buffers, ring = None, inline = (), path = ()):
+    if isinstance(value, dict):
+        encoded = {}
+        for key, item in value.items():
+            item_path = path + (str(key),)
+            item_ring = None if item_path in inline else ring
+            encoded[str(key)] = _encode_tree(item, buffers, item_ring, inline, item_path)
+        return encoded
+
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("Arrays of Python objects cannot be sent over the live socket")
+        if ring is not None and value.nbytes >= SHM_MIN_BYTES:
+            position = ring.put(value)
+            if position is not None:
+                return {SHM_KEY: position,
+                        'ring': ring.name,
+                        'dtype': value.dtype.str,
+                        'shape': list(value.shape)}
+        # np.ascontiguousarray would turn 0-d arrays into shape (1,)
+        array = value if value.flags.c_contiguous else value.copy(order='C')
+        buffers.append(array)
+        return {ARRAY_KEY: len(buffers) - 1,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape)}
+
+    if isinstance(value, (list, tuple)):
+        return [_encode_tree(item, buffers, ring, inline, path) for item in value]
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def _decode_tree(value, buffers, rings, stale, path = ()):
+    if isinstance(value, dict):
+        if ARRAY_KEY in value:
+            array = np.frombuffer(buffers[value[ARRAY_KEY]], dtype=np.dtype(value['dtype']))
+            array.flags.writeable = False
+            return array.reshape(value['shape'])
+        if SHM_KEY in value:
+            if rings is None:
+                raise ValueError("Frame refers to shared memory, pass rings to recv_data")
+            try:
+                ring = rings.get(value['ring'])
+                if ring is None:
+                    try:
+                        ring = rings[value['ring']] = SharedRing(value['ring'])
+                    except FileNotFoundError:
+                        raise StaleFrame(f"Shared memory {value['ring']} is gone") from None
+                return ring.get(value[SHM_KEY], value['dtype'], value['shape'])
+            except StaleFrame:
+                stale.append(list(path))
+                return None
+        return {key: _decode_tree(item, buffers, rings, stale, path + (key,))
+                for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [_decode_tree(item, buffers, rings, stale, path + (index,))
+                for index, item in enumerate(value)]
+
+    return value
+
+
+def send_data(socket, data, topic = b'', header = None, flags = 0, ring = None, inline = ()):
+    """
+    Send a nested dict of numpy arrays as one multipart ZMQ message.
+
+    The message consists of the topic, a JSON header describing the structure
+    (arrays replaced by name, dtype and shape placeholders) and one frame per
+    array. Array frames are handed to ZMQ without copying, so the arrays must
+    not be modified in place until the message is sent.
+
+    Parameters:
+        socket (zmq.Socket): Socket to send on, usually PUB.
+        data (dict): Nested dict of arrays, numbers, strings and lists.
+        topic (bytes): Topic frame, SUB sockets filter on it.
+        header (dict): Additional JSON-serialisable header fields.
+        flags (int): ZMQ send flags, e.g. NOBLOCK.
+        ring (SharedRing): Ring for large arrays, the receiver has to run on
+                           the same host.
+        inline (set): Key paths into data, e.g. ("data", "Plot1", "part1"),
+                      whose arrays are always sent in the message, never
+                      through the ring.
+    """
+    buffers = []
+    message = dict(header or {})
+    if ring is not None:
+        # Lets receivers release the rings of producers that moved on
+        message['ring'] = ring.name
+    message['data'] = _encode_tree(data, buffers, ring, set(inline))
+    frames = [topic, json.dumps(message).encode('utf-8')] + buffers
+    socket.send_multipart(frames, flags=flags, copy=False)
+
+
+def recv_data(socket, flags = 0, rings = None):
+    """
+    Receive a message sent by send_data.
+
+    Arrays are reconstructed with np.frombuffer directly on the received
+    frames without copying, or copied out of shared memory. They are
+    read-only. Arrays the producer overwrote in shared memory before they
+    were read are decoded as None, and their key paths listed in
+    header["stale"], so the rest of the message is still delivered.
+
+    Parameters:
+        socket (zmq.Socket): Socket to receive on, usually SUB.
+        flags (int): ZMQ receive flags, e.g. NOBLOCK.
+        rings (dict): Ring name -> SharedRing, rings are attached on first use
+                      and added to it. Owned and closed by the caller.
+
+    Returns:
+        tuple: (topic, header, data)
+    """
+    frames = socket.recv_multipart(flags=flags, copy=False)
+    topic = frames[0].bytes
+    header = json.loads(frames[1].bytes)
+    stale = []
+    data = _decode_tree(header.pop('data', None), [frame.buffer for frame in frames[2:]],
+                        rings, stale)
+    if stale:
+        header['stale'] = stale
+    return topic, header, data
+
+
+def layout_hash(layout):
+    """
+    Stable hash of a layout dict, used as its version in the session protocol.
+    """
+    encoded = json.dumps(_encode_tree(layout, []), sort_keys=True, default=repr)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _fingerprint(value, digest = None):
+    digest = digest or hashlib.blake2b(digest_size=16)
+    if isinstance(value, dict):
+        for key in sorted(value):
+            digest.update(str(key).encode('utf-8'))
+            _fingerprint(value[key], digest)
+    elif isinstance(value, np.ndarray):
+        digest.update(f"{value.dtype.str}{value.shape}".encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).data)
+    else:
+        digest.update(repr(value).encode('utf-8'))
+    return digest.digest()
+
+
+def append_parts(layout):
+    """
+    Parts of a layout in append mode.
+
+    Returns:
+        set: (graph, part) tuples whose config has "mode": "append".
+    """
+    return {(graph, part)
+            for graph, graph_config in (layout or {}).items()
+            for part, part_config in graph_config.get('content', {}).items()
+            if part_config.get('mode') == APPEND_MODE}
+
+
+def inline_paths(layout, data = None):
+    """
+    Key paths of a session payload that send_data must not put into a ring.
+
+    Append mode parts and HeatMap patches are sent only once, an overwritten
+    ring slot would lose them for good: key frames repeat the latest value of
+    a part, which for a patched HeatMap is only its last patch. Other parts
+    are repeated whole by key frames.
+
+    Parameters:
+        layout (dict): Layout of the session.
+        data (dict): graph -> part -> values of the payload to send.
+    """
+    paths = {('data', graph, part) for graph, part in append_parts(layout)}
+    for graph, parts in (data or {}).items():
+        for part, values in parts.items():
+            if isinstance(values, Mapping) and any(key in values for key in PATCH_KEYS + (PATCHES_KEY,)):
+                paths.add(('data', graph, part))
+    return paths
+
+
+def _has_rows(part_data):
+    return any(isinstance(value, np.ndarray) and value.ndim and len(value)
+               for value in part_data.values())
+
+
+class SessionEncoder:
+    '''
+    Producer side of the live session protocol.
+
+    A layout frame carries the layout, its hash and every part (a key frame).
+    It is sent when the layout changes and repeated every keyframe_interval
+    seconds. In between, data frames carry the layout hash, the top-level
+    fields of the pack (iter, metadata, ...) and only the parts whose contents
+    changed since they were last sent.
+
+    Parts in append mode hold only the points added since the previous send.
+    They are sent whenever they are not empty and are never repeated in key
+    frames, the receiver concatenates them. Points of a frame the transport
+    drops (a full high water mark, a viewer that is not connected yet) are
+    lost for good, the series joins across the gap.
+
+    Every header carries the id of the session, a new encoder starts a new
+    one, so receivers never join the series of a restarted producer onto
+    those of the previous run.
+    '''
+
+    def __init__(self, keyframe_interval = KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.session = uuid.uuid4().hex
+        self.layout_hash = None
+        self._fingerprints = {}
+        self._last_keyframe = None
+
+    def encode(self, data_pack, changed = None):
+        """
+        Split a data pack into the header and payload of the next frame.
+
+        Parameters:
+            data_pack (dict): Pack with layout, data and top-level fields.
+            changed (set): (graph, part) tuples that may have changed since
+                           the last call. Only these are hashed and compared,
+                           the others are only sent in key frames. None
+                           compares every part.
+
+        Returns:
+            tuple: (header, payload)
+        """
+        layout = data_pack.get('layout')
+        digest = layout_hash(layout)
+        now = time.monotonic()
+        keyframe = (digest != self.layout_hash
+                    or self._last_keyframe is None
+                    or now - self._last_keyframe >= self.keyframe_interval)
+
+        payload = {key: value for key, value in data_pack.items() if key not in ('layout', 'data')}
+        payload['data'] = {}
+        appended = append_parts(layout)
+        for graph, graph_data in data_pack.get('data', {}).items():
+            for part, part_data in graph_data.items():
+                if (graph, part) in appended:
+                    if _has_rows(part_data):
+                        payload['data'].setdefault(graph, {})[part] = part_data
+                    continue
+                if changed is not None and (graph, part) not in changed:
+                    if keyframe:
+                        payload['data'].setdefault(graph, {})[part] = part_data
+                    continue
+                fingerprint = _fingerprint(part_data)
+                if keyframe or self._fingerprints.get((graph, part)) != fingerprint:
+                    payload['data'].setdefault(graph, {})[part] = part_data
+                self._fingerprints[(graph, part)] = fingerprint
+
+        if keyframe:
+            payload['layout'] = layout
+            self.layout_hash = digest
+            self._last_keyframe = now
+
+        header = {'kind': LAYOUT_FRAME if keyframe else DATA_FRAME,
+                  'session': self.session,
+                  'layout_hash': digest}
+        return header, payload
+
+    def send(self, socket, data_pack, topic = b'', flags = 0, ring = None, changed = None):
+        header, payload = self.encode(data_pack, changed)
+        send_data(socket, payload, topic=topic, header=header, flags=flags, ring=ring,
+                  inline=inline_paths(data_pack.get('layout'), payload['data']))
+
+
+def _drop_stale(payload, stale):
+    """
+    Remove the parts (or top-level fields) of a payload holding an array that
+    went stale in shared memory. The other parts stay, append batches are
+    never sent through a ring. False if the layout itself is stale.
+    """
+    for path in stale:
+        if path[0] == 'layout':
+            return False
+        if path[0] == 'data' and len(path) >= 3:
+            payload['data'].get(path[1], {}).pop(path[2], None)
+        else:
+            payload.pop(path[0], None)
+    return True
+
+
+class SessionDecoder:
+    '''
+    Receiver side of the live session protocol for a single stream.
+    '''
+
+    def __init__(self):
+        self.layout = None
+        self.layout_hash = None
+        self.session = None
+
+    def decode(self, header, payload):
+        """
+        Interpret a received frame.
+
+        Returns:
+            tuple: (layout_changed, payload). payload only holds the parts sent
+                   with this frame and is None for data frames of a layout or
+                   session the decoder has not seen yet, those wait for the
+                   next key frame. Parts whose arrays went stale in shared
+                   memory are left out, key frames repeat them. The session of
+                   the stream is self.session.
+        """
+        if not _drop_stale(payload, header.get('stale', ())):
+            return False, None
+
+        if header.get('kind') == LAYOUT_FRAME:
+            layout_changed = header['layout_hash'] != self.layout_hash
+            self.layout = payload.pop('layout')
+            self.layout_hash = header['layout_hash']
+            self.session = header.get('session')
+            return layout_changed, payload
+
+        if (self.layout_hash is None
+                or header.get('layout_hash') != self.layout_hash
+                or header.get('session') != self.session):
+            return False, None
+        return False, payload
+
+
+def _patches_of(data):
+    if PATCHES_KEY in data:
+        return list(data[PATCHES_KEY])
+    patch = {key: data[key] for key in PATCH_KEYS if key in data}
+    return [patch] if patch else []
+
+
+def merge_part_data(older, newer):
+    """
+    Combine two successive values of a part that were not drawn in between.
+
+    The newer value wins, except that the HeatMap patches of both are kept
+    as an ordered list under PATCHES_KEY, so applying the result equals
+    applying both in order. A full image in the newer value replaces
+    everything before it.
+    """
+    if not isinstance(older, Mapping) or 'z' in newer:
+        return newer
+    patches = _patches_of(older) + _patches_of(newer)
+    merged = {key: value for key, value in older.items()
+              if key not in PATCH_KEYS and key != PATCHES_KEY}
+    merged.update((key, value) for key, value in newer.items()
+                  if key not in PATCH_KEYS and key != PATCHES_KEY)
+    if patches:
+        merged[PATCHES_KEY] = patches
+    return merged
+
+
+class Conflator:
+    '''
+    Merges the decoded frames of one stream until the GUI takes them.
+
+    Top-level fields and parts keep their newest value, so a frame that is
+    superseded before it is drawn never loses the only update of a part.
+    HeatMap patches (z_rows, z_cols, z_region) of merged frames are kept in
+    order instead of replaced.
+    Append mode parts are concatenated into a per-stream history instead, the
+    GUI always receives the full series of the points that arrived. A layout
+    change drops everything merged for the previous layout, a new session
+    (a restarted producer) drops the history.
+    '''
+
+    def __init__(self):
+        self.layout = None
+        self.session = None
+        self._appended = set()
+        self._history = {}
+        self._layout_changed = False
+        self._pending = None
+
+    def push(self, layout_changed, layout, payload, session = None):
+        if layout_changed:
+            self.layout = layout
+            self._appended = append_parts(layout)
+            self._layout_changed = True
+            self._pending = None
+        if layout_changed or session != self.session:
+            self.session = session
+            self._history = {}
+
+        if self._pending is None:
+            self._pending = {'data': {}}
+        self._pending.update((key, value) for key, value in payload.items() if key != 'data')
+
+        for graph, graph_data in payload.get('data', {}).items():
+            merged = self._pending['data'].setdefault(graph, {})
+            for part, part_data in graph_data.items():
+                if (graph, part) in self._appended:
+                    part_data = self._extend(graph, part, part_data)
+                elif part in merged:
+                    part_data = merge_part_data(merged[part], part_data)
+                merged[part] = part_data
+
+    def _extend(self, graph, part, chunk):
+        history = self._history.setdefault((graph, part), {})
+        merged = {}
+        for key, values in chunk.items():
+            if isinstance(values, np.ndarray) and values.ndim:
+                if key in history:
+                    history[key].extend(values)
+                else:
+                    history[key] = AppendBuffer(values)
+            else:
+                merged[key] = values
+
+        # Views stay valid while the buffers grow, growing only writes past them
+        merged.update((key, buffer.view) for key, buffer in history.items())
+        return merged
+
+    def take(self):
+        """
+        Collect everything merged since the last call.
+
+        Returns:
+            tuple: (layout_changed, layout, payload), or None if nothing arrived.
+        """
+        if self._pending is None:
+            return None
+        frame = (self._layout_changed, self.layout, self._pending)
+        self._layout_changed = False
+        self._pending = None
+        return frame
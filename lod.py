@@ -0,0 +1,265 @@
+import warnings
+import numpy as np
+
+# Traces with fewer points than this are drawn as they are
+DECIMATION_THRESHOLD = 10_000
+
+# Decimation methods of LineDecimator
+MINMAX = 'minmax'
+LTTB = 'lttb'
+
+# Pixel width assumed before a view has been laid out
+DEFAULT_WIDTH = 2000
+
+# Images with more pixels than this are drawn through an ImagePyramid
+PYRAMID_THRESHOLD = 1024 * 1024
+
+# The coarsest pyramid level is at most this many pixels along either axis
+MIN_LEVEL_SIZE = 256
+
+# Fraction of the visible size a served tile extends beyond the view on every
+# side, so small pans do not need a new tile
+TILE_MARGIN = 0.5
+
+
+def _is_sorted(x):
+    return x.size < 2 or bool(np.all(x[1:] >= x[:-1]))
+
+
+def minmax_decimate(x, y, n_buckets):
+    """
+    Reduce a trace with sorted x to the minimum and maximum of y in each of
+    n_buckets equally wide x intervals, the bucket being a screen pixel.
+
+    The result draws the same picture as the full trace at that resolution:
+    every bucket becomes a vertical segment from its minimum to its maximum.
+    NaNs are ignored, buckets holding only NaNs stay NaN (a gap).
+
+    Returns:
+        tuple: (x, y) with at most 2 * n_buckets points.
+    """
+    if x.size <= 2 * n_buckets:
+        return x, y
+
+    edges = np.linspace(x[0], x[-1], n_buckets + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1], side='left'))
+    starts = starts[starts < x.size]
+
+    with np.errstate(invalid='ignore'):
+        y_min = np.fmin.reduceat(y, starts)
+        y_max = np.fmax.reduceat(y, starts)
+
+    x_out = np.repeat(x[starts], 2)
+    y_out = np.empty(x_out.size, dtype=np.result_type(y_min, y_max))
+    y_out[0::2] = y_min
+    y_out[1::2] = y_max
+    # The last point of the trace stays exact, the line ends where the data ends
+    return np.append(x_out, x[-1]), np.append(y_out, y[-1])
+
+
+def lttb_decimate(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a trace with sorted x.
+
+    Keeps the first and last point and from every bucket in between the
+    point spanning the largest triangle with its neighbours, which preserves
+    the visual shape better than min/max at the cost of a loop over buckets.
+
+    Returns:
+        tuple: (x, y) with n_out points.
+    """
+    n = x.size
+    if n <= n_out or n_out < 3:
+        return x, y
+
+    bounds = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = bounds[i], bounds[i + 1]
+        next_start, next_stop = stop, bounds[i + 2] if i + 2 < len(bounds) else n
+        # Average of the next bucket is the third corner of the triangle
+        x_c = x[next_start:next_stop].mean()
+        y_c = np.nanmean(y[next_start:next_stop]) if next_stop > next_start else y[-1]
+
+        areas = np.abs((x[a] - x_c) * (y[start:stop] - y[a])
+                       - (x[a] - x[start:stop]) * (y_c - y[a]))
+        a = start + int(np.nanargmax(areas)) if np.any(np.isfinite(areas)) else start
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+class LineDecimator:
+    '''
+    View dependent decimation of one trace.
+
+    The trace is cut to the visible x range (plus one point on either side,
+    so lines leave the view correctly) and reduced to about two points per
+    pixel. The result is cached and only recomputed when the data, the x range
+    or the pixel width changes.
+    '''
+
+    def __init__(self, method = MINMAX, threshold = DECIMATION_THRESHOLD):
+        if method not in (MINMAX, LTTB):
+            raise ValueError(f"Unknown decimation method: {method}")
+        self.method = method
+        self.threshold = threshold
+        self.x = None
+        self.y = None
+        self._sorted = False
+        self._key = None
+        self._result = None
+
+    def setData(self, x, y):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self._sorted = self.x.ndim == 1 and self.x.shape == self.y.shape and _is_sorted(self.x)
+        self._key = None
+        self._result = None
+
+    def decimate(self, x_range = None, width = DEFAULT_WIDTH):
+        """
+        Parameters:
+            x_range (tuple): Visible (x_min, x_max), None for the whole trace.
+            width (int): Width of the view in pixels.
+
+        Returns:
+            tuple: (x, y) to draw.
+        """
+        if self.x is None:
+            return None, None
+
+        width = max(int(width), 1)
+        if self.x.size <= self.threshold:
+            key = None  # Drawn whole, whatever the view
+        else:
+            key = (None if x_range is None else tuple(x_range), width)
+        if self._result is not None and key == self._key:
+            return self._result
+
+        if key is None:
+            self._key, self._result = key, (self.x, self.y)
+            return self._result
+
+        x, y = self.x, self.y
+        if not self._sorted:
+            # No x order to bucket by, fall back to a fixed stride
+            step = max(x.size // (2 * width), 1)
+            self._result = (x[::step], y[::step]) if x.ndim == 1 else (x, y)
+        else:
+            if x_range is not None:
+                start = max(np.searchsorted(x, x_range[0], side='left') - 1, 0)
+                stop = min(np.searchsorted(x, x_range[1], side='right') + 1, x.size)
+                x, y = x[start:stop], y[start:stop]
+
+            if self.method == LTTB:
+                self._result = lttb_decimate(x, y, 2 * width)
+            else:
+                self._result = minmax_decimate(x, y, width)
+
+        self._key = key
+        return self._result
+
+
+def _downsample(image):
+    """
+    Halve an image along both axes by averaging 2x2 blocks, ignoring NaNs.
+    Odd sizes are padded with NaN, so the last row/column is averaged alone.
+    """
+    rows, cols = image.shape
+    padded = np.full((rows + rows % 2, cols + cols % 2), np.nan,
+                     dtype=np.result_type(image.dtype, np.float32))
+    padded[:rows, :cols] = image
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN blocks stay NaN
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+class ImagePyramid:
+    '''
+    Mipmap of a 2D image, level k holding the image averaged over 2^k x 2^k
+    pixel blocks, down to MIN_LEVEL_SIZE pixels.
+
+    Coordinates are (row, column) of the level 0 image. levelFor picks the
+    coarsest level that still has one image pixel per screen pixel, tile the
+    part of a level to draw for the current view.
+    '''
+
+    def __init__(self, image, min_size = MIN_LEVEL_SIZE):
+        self.min_size = min_size
+        self.setImage(image)
+
+    def setImage(self, image):
+        self.levels = [image]
+        while max(self.levels[-1].shape) > self.min_size:
+            self.levels.append(_downsample(self.levels[-1]))
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def updateRegion(self, row_start, row_stop, col_start = 0, col_stop = None):
+        """
+        Recompute the coarser levels after a region of level 0 changed in place.
+
+        Parameters:
+            row_start (int): First changed row.
+            row_stop (int): Row after the last changed row.
+            col_start (int): First changed column.
+            col_stop (int): Column after the last changed column, None for all.
+        """
+        if col_stop is None:
+            col_stop = self.shape[1]
+        for level in range(1, len(self.levels)):
+            row_start, row_stop = row_start // 2, (row_stop + 1) // 2
+            col_start, col_stop = col_start // 2, (col_stop + 1) // 2
+            region = _downsample(self.levels[level - 1][2 * row_start:2 * row_stop,
+                                                        2 * col_start:2 * col_stop])
+            self.levels[level][row_start:row_stop, col_start:col_stop] = \
+                region[:row_stop - row_start, :col_stop - col_start]
+
+    def levelFor(self, rows, cols, pixels):
+        """
+        Parameters:
+            rows (tuple): Visible (start, stop) rows of the level 0 image.
+            cols (tuple): Visible (start, stop) columns of the level 0 image.
+            pixels (tuple): (height, width) of the view on screen.
+
+        Returns:
+            int: Index of the level to draw.
+        """
+        density = min((rows[1] - rows[0]) / max(pixels[0], 1),
+                      (cols[1] - cols[0]) / max(pixels[1], 1))
+        if density < 2:
+            return 0
+        return min(int(np.log2(density)), len(self.levels) - 1)
+
+    def tile(self, level, rows, cols, margin = TILE_MARGIN):
+        """
+        Region of a level covering the visible rows and columns plus a margin.
+
+        Returns:
+            tuple: (row_start, row_stop, col_start, col_stop) in pixels of the level.
+        """
+        factor = 2 ** level
+        height, width = self.levels[level].shape
+        row_margin = margin * (rows[1] - rows[0])
+        col_margin = margin * (cols[1] - cols[0])
+        return (max(int((rows[0] - row_margin) // factor), 0),
+                min(int(np.ceil((rows[1] + row_margin) / factor)), height),
+                max(int((cols[0] - col_margin) // factor), 0),
+                min(int(np.ceil((cols[1] + col_margin) / factor)), width))
+
+    def covers(self, level, tile, rows, cols):
+        """
+        True if a tile of a level still contains the visible rows and columns.
+        """
+        factor = 2 ** level
+        height, width = self.shape
+        return (tile[0] * factor <= rows[0] and rows[1] <= min(tile[1] * factor, height)
+                and tile[2] * factor <= cols[0] and cols[1] <= min(tile[3] * factor, width))
@@ -7,11 +7,35 @@ import numpy as np
 import sys
 import cmasher as cmr
 from functools import partial
+from pyqtgraph.Qt import internals
+from pyqtgraph.graphicsItems.ScatterPlotItem import renderSymbol
+
+from lod import LineDecimator, MINMAX, ImagePyramid, PYRAMID_THRESHOLD
 
 MAP_LAYER = -100
 LINE_LAYER = -50
 SCATTER_LAYER = -20
 
+# Scatter traces with more points are drawn by a FastScatterItem, without
+# hover and per point styling, None disables
+SCATTER_FAST_THRESHOLD = 20_000
+
+# Scatter traces with more points are drawn as a density image, None disables
+SCATTER_DENSITY_THRESHOLD = 500_000
+
+# Bins along each axis of the density image of a scatter trace
+DENSITY_BINS = 512
+
+# Bins of the histograms of HeatMaps
+HISTOGRAM_BINS = 256
+
+# Images with more pixels are histogrammed from a random sample of this size
+HISTOGRAM_SAMPLES = 1_000_000
+
+# Values of the "axis_order" HeatMap option: z[y, x] (default) or z[x, y]
+ROW_MAJOR = 'row-major'
+COL_MAJOR = 'col-major'
+
 WIDTH = 3
 NCOLORS = 7
 
@@ -48,6 +72,9 @@ class LinePlot(AbstractPlot):
         self.x_values = None
         self.y_values = None
 
+        self.decimator : LineDecimator = None
+        self._drawn = None
+
         self._visible = True
 
     def updateLayout(self, plot_item, key, value, **kwargs):
@@ -57,10 +84,35 @@ class LinePlot(AbstractPlot):
         self.plotItem.setZValue(LINE_LAYER)
         # plot_item.setTitle(value.get("title", key))
 
+        # "decimation": "minmax" (default), "lttb" or None to draw every point
+        method = value.get("decimation", MINMAX)
+        if method:
+            self.decimator = LineDecimator(method)
+            self.viewBox = plot_item.getViewBox()
+            self.viewBox.sigXRangeChanged.connect(self._redraw)
+            self.viewBox.sigResized.connect(self._redraw)
+
     def updateData(self, data):
         self.x_values = data.get("x", [])
         self.y_values = data.get("y", [])
-        self.plotItem.setData(self.x_values, self.y_values)
+        if self.decimator is None:
+            self.plotItem.setData(self.x_values, self.y_values)
+            return
+
+        self.decimator.setData(self.x_values, self.y_values)
+        self._redraw()
+
+    def _redraw(self, *args):
+        if self.decimator is None or self.decimator.x is None:
+            return
+
+        # While auto ranging the whole trace is visible, and has to be handed
+        # over whole so the auto range does not shrink to the current view
+        x_range = None if self.viewBox.autoRangeEnabled()[0] else self.viewBox.viewRange()[0]
+        decimated = self.decimator.decimate(x_range, self.viewBox.width())
+        if decimated is not self._drawn:
+            self._drawn = decimated
+            self.plotItem.setData(*decimated)
 
     def setVisible(self, visible: bool):
         if self.plotItem and self._visible != visible:
@@ -69,39 +121,200 @@ class LinePlot(AbstractPlot):
 
 
 
+class FastScatterItem(pg.GraphicsObject):
+    '''
+    Scatter item for large uniform traces.
+
+    The symbol is rendered into a pixmap once, points are kept as two arrays
+    and drawn as pixmap fragments built with numpy, with points outside the
+    viewport culled and points falling on the same device pixel drawn once.
+    Nothing is created per point, neither on setData nor on paint.
+    '''
+
+    def __init__(self, symbol = "o", size = 8, pen = None, brush = None):
+        super().__init__()
+        pen = pen if pen is not None else pg.mkPen(pg.getConfigOption('foreground'))
+        brush = brush if brush is not None else pg.mkBrush(100, 100, 150)
+        self.size = size
+        self._pixmap = QtGui.QPixmap.fromImage(renderSymbol(symbol, size, pen, brush))
+        self._fragments = internals.PrimitiveArray(QtGui.QPainter.PixmapFragment, 10)
+
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        self._bounds = None
+
+    def setData(self, x, y):
+        self.x = np.asarray(x, dtype=float).ravel()
+        self.y = np.asarray(y, dtype=float).ravel()
+        finite = np.isfinite(self.x) & np.isfinite(self.y)
+        if finite.all():
+            finite = slice(None)
+        if self.x[finite].size:
+            self._bounds = (self.x[finite].min(), self.x[finite].max(),
+                            self.y[finite].min(), self.y[finite].max())
+        else:
+            self._bounds = None
+        self.prepareGeometryChange()
+        self.informViewBoundsChanged()
+        self.update()
+
+    def dataBounds(self, ax, frac = 1.0, orthoRange = None):
+        if self._bounds is None:
+            return (None, None)
+        return self._bounds[2 * ax:2 * ax + 2]
+
+    def pixelPadding(self):
+        return self.size * 0.5
+
+    def viewTransformChanged(self):
+        # The padding of the bounding rect is in pixels
+        self.prepareGeometryChange()
+
+    def boundingRect(self):
+        if self._bounds is None:
+            return QtCore.QRectF()
+        x_min, x_max, y_min, y_max = self._bounds
+        try:
+            px, py = self.pixelVectors()
+            px = 0 if px is None else px.length() * self.pixelPadding()
+            py = 0 if py is None else py.length() * self.pixelPadding()
+        except OverflowError:
+            px = py = 0
+        return QtCore.QRectF(x_min - px, y_min - py, x_max - x_min + 2 * px, y_max - y_min + 2 * py)
+
+    def paint(self, p, *args):
+        if not self.x.size:
+            return
+
+        transform = p.transform()
+        x = transform.m11() * self.x + transform.m21() * self.y + transform.dx()
+        y = transform.m12() * self.x + transform.m22() * self.y + transform.dy()
+
+        viewport = p.viewport()
+        pad = self.size
+        with np.errstate(invalid='ignore'):
+            visible = ((x > viewport.left() - pad) & (x < viewport.right() + pad)
+                       & (y > viewport.top() - pad) & (y < viewport.bottom() + pad))
+        x, y = np.rint(x[visible]), np.rint(y[visible])
+        if not x.size:
+            return
+
+        # One fragment per occupied device pixel
+        keys = np.unique((x.astype(np.int64) << 32) + (y.astype(np.int64) & 0xFFFFFFFF))
+        self._fragments.resize(keys.size)
+        fragments = self._fragments.ndarray()
+        fragments[:, 0] = keys >> 32
+        fragments[:, 1] = (keys & 0xFFFFFFFF).astype(np.int32)
+        fragments[:, 2:6] = (0, 0, self._pixmap.width(), self._pixmap.height())
+        fragments[:, 6:10] = (1.0, 1.0, 0.0, 1.0)
+
+        p.save()
+        p.resetTransform()
+        p.drawPixmapFragments(*self._fragments.drawargs(), self._pixmap)
+        p.restore()
+
+
 class ScatterPlot(AbstractPlot):
+    # Items drawing the trace, depending on its number of points
+    POINTS, FAST, DENSE = range(3)
+
     def __init__(self):
         super().__init__()
         self.plotItem = None
+        self.fastItem = None
+        self.densityItem = None
 
         self.x_values = None
         self.y_values = None
 
+        self.fast_threshold = SCATTER_FAST_THRESHOLD
+        self.density_threshold = SCATTER_DENSITY_THRESHOLD
+        self._mode = self.POINTS
         self._visible = True
 
     def updateLayout(self, plot_item, key, value, **kwargs):
         # Use the specified pen in the configuration
         pen = kwargs.get("pen", pg.mkPen("black"))  # Default to black if no pen
         brush = pg.mkBrush(pen.color())  # Use pen color for the scatter brush
+        self.color = pen.color()
         self.plotItem = pg.ScatterPlotItem(symbol="o", size=8, brush=brush)
         self.plotItem.setZValue(SCATTER_LAYER)
         plot_item.addItem(self.plotItem)
         plot_item.setTitle(value.get("title", key))
 
+        # Above "fast_threshold" points the trace is drawn by a FastScatterItem,
+        # above "density_threshold" points as a density image
+        self.fast_threshold = value.get("fast_threshold", SCATTER_FAST_THRESHOLD)
+        self.fastItem = FastScatterItem(symbol="o", size=8, brush=brush)
+        self.fastItem.setZValue(SCATTER_LAYER)
+        self.fastItem.setVisible(False)
+        plot_item.addItem(self.fastItem)
+
+        self.density_threshold = value.get("density_threshold", SCATTER_DENSITY_THRESHOLD)
+        self.densityItem = pg.ImageItem(axisOrder='row-major')
+        self.densityItem.setZValue(SCATTER_LAYER)
+        self.densityItem.setVisible(False)
+        plot_item.addItem(self.densityItem)
+
     def updateData(self, data):
-        self.x_values = data.get("x", None)
-        self.y_values = data.get("y", None)
-        self.plotItem.setData(self.x_values, self.y_values)
+        self.x_values = np.asarray(data.get("x", []), dtype=float)
+        self.y_values = np.asarray(data.get("y", []), dtype=float)
+
+        size = self.x_values.size
+        if self.density_threshold is not None and size > self.density_threshold:
+            mode = self.DENSE
+        elif self.fast_threshold is not None and size > self.fast_threshold:
+            mode = self.FAST
+        else:
+            mode = self.POINTS
+
+        if mode == self.DENSE:
+            self._updateDensity(self.x_values, self.y_values)
+        if mode == self.FAST:
+            self.fastItem.setData(self.x_values, self.y_values)
+        elif self._mode == self.FAST:
+            self.fastItem.setData([], [])
+        if mode == self.POINTS:
+            self.plotItem.setData(self.x_values, self.y_values)
+        elif self._mode == self.POINTS:
+            self.plotItem.setData([], [])
+
+        self._mode = mode
+        self._showMode()
+
+    def _showMode(self):
+        self.plotItem.setVisible(self._visible and self._mode == self.POINTS)
+        self.fastItem.setVisible(self._visible and self._mode == self.FAST)
+        self.densityItem.setVisible(self._visible and self._mode == self.DENSE)
+
+    def _updateDensity(self, x, y):
+        finite = np.isfinite(x) & np.isfinite(y)
+        counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=DENSITY_BINS)
+
+        # Colour of the trace, opacity growing with the square root of the density
+        image = np.empty(counts.shape[::-1] + (4,), dtype=np.uint8)
+        image[..., 0] = self.color.red()
+        image[..., 1] = self.color.green()
+        image[..., 2] = self.color.blue()
+        image[..., 3] = 255 * np.sqrt(counts.T / max(counts.max(), 1))
+        self.densityItem.setImage(image, autoLevels=False)
+
+        transform = QtGui.QTransform()
+        transform.translate(x_edges[0], y_edges[0])
+        transform.scale((x_edges[-1] - x_edges[0]) / DENSITY_BINS,
+                        (y_edges[-1] - y_edges[0]) / DENSITY_BINS)
+        self.densityItem.setTransform(transform)
 
     def setVisible(self, visible: bool):
         if self.plotItem and self._visible != visible:
-            self.plotItem.setVisible(visible)
             self._visible = visible
+            self._showMode()
 
 class Counts(AbstractPlot):
     def __init__(self):
         super().__init__()
-        self.lines = []
+        self.plotItem : pg.PlotCurveItem = None
+        self.x_values = None
         self._visible = True
 
     def updateLayout(self, plot_item, key, value, **kwargs):
@@ -111,23 +324,90 @@ class Counts(AbstractPlot):
         self.plot_item.setLimits(yMin=0, yMax=1, minYRange=1)
         self.plot_item.setTitle(value.get("title", key))
 
-    def updateData(self, data):
-        # Clear previous lines
-        for line in self.lines:
-            line.hide()
+        # All counts are drawn by one item, as vertical segments over the
+        # y range of the plot, consecutive point pairs forming a segment
+        self.plotItem = pg.PlotCurveItem(pen=self.pen, connect='pairs')
+        self.plot_item.addItem(self.plotItem)
 
-        # Draw new lines using the specified pen
-        self.lines = [
-            self.plot_item.addLine(x=t, pen=self.pen) for t in data.get("x", [])
-        ]
+    def updateData(self, data):
+        self.x_values = np.asarray(data.get("x", []), dtype=float).ravel()
+        self.plotItem.setData(np.repeat(self.x_values, 2),
+                              np.tile([0.0, 1.0], self.x_values.size))
 
     def setVisible(self, visible: bool):
-        if self.plot_item and self._visible != visible:
-            for line in self.lines:
-                line.setVisible(visible)
+        if self.plotItem and self._visible != visible:
+            self.plotItem.setVisible(visible)
             self._visible = visible
 
 
+class ImageHistogram:
+    '''
+    Histogram of an image with fixed bins. When part of the image changes it
+    is patched by removing the old and adding the new values, instead of
+    histogramming every pixel again.
+
+    Images with more than max_samples pixels are histogrammed from a random
+    sample, with the counts scaled up to the size of the image.
+    '''
+
+    def __init__(self, bins = HISTOGRAM_BINS, max_samples = HISTOGRAM_SAMPLES):
+        self.bins = bins
+        self.max_samples = max_samples
+        self.edges : np.ndarray = None
+        self.counts : np.ndarray = None
+        self._rng = np.random.default_rng()
+
+    @property
+    def centers(self):
+        return (self.edges[:-1] + self.edges[1:]) * 0.5
+
+    def compute(self, image):
+        values = image.ravel()
+        scale = 1.0
+        if values.size > self.max_samples:
+            scale = values.size / self.max_samples
+            values = values[self._rng.integers(0, values.size, self.max_samples)]
+
+        finite = values[np.isfinite(values)]
+        if not finite.size:
+            self.edges, self.counts = None, None
+            return
+        low, high = finite.min(), finite.max()
+        if high <= low:
+            high = low + 1
+        self.edges = np.linspace(low, high, self.bins + 1)
+        self.counts = np.histogram(finite, bins=self.edges)[0] * scale
+
+    def patch(self, old, new):
+        """
+        Replace the values old by new.
+
+        Returns:
+            bool: False if new values fall outside the bins, the histogram
+                  then has to be computed again.
+        """
+        if self.edges is None:
+            return False
+        old = old[np.isfinite(old)]
+        new = new[np.isfinite(new)]
+        if new.size and (new.min() < self.edges[0] or new.max() > self.edges[-1]):
+            return False
+        self.counts -= np.histogram(old, bins=self.edges)[0]
+        self.counts += np.histogram(new, bins=self.edges)[0]
+        return True
+
+
+class MapImageItem(pg.ImageItem):
+    '''
+    ImageItem of a Map, carrying the histogram of the whole image rather than
+    only of the drawn tile.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histogram = ImageHistogram()
+
+
 class Map(AbstractPlot):
     def __init__(self):
         super().__init__()
@@ -137,43 +417,227 @@ class Map(AbstractPlot):
         self.y_values = None
         self.z_values = None
 
+        # Row-major copy of z that is drawn, reused and updated in place as
+        # long as the shape does not change
+        self.axis_order = ROW_MAJOR
+        self._buffer : np.ndarray = None
+
+        # Images above PYRAMID_THRESHOLD pixels are served from a pyramid,
+        # only the tile matching the zoom level and viewport is drawn
+        self.pyramid : ImagePyramid = None
+        self._tile = None
+        self._extent = None
+        self._scale = (1, 1)
+        self._translate = (0, 0)
+
         self._visible = True
 
     def updateLayout(self, plot_item, key, value, **kwargs):
-        # Add the heatmap (ImageItem) to the provided PlotItem
-        self.plotItem = pg.ImageItem()
+        # Add the heatmap (ImageItem) to the provided PlotItem. Row-major
+        # images are drawn as they are, without a transposed copy.
+        self.plotItem = MapImageItem(axisOrder=ROW_MAJOR)
         self.plotItem.setZValue(MAP_LAYER + kwargs.get("z_value", 0))
         # self.plotItem.setColorMap(cmap_map)
         plot_item.addItem(self.plotItem)
         plot_item.setTitle(value.get("title", key))
 
+        self.axis_order = value.get("axis_order", ROW_MAJOR)
+        if self.axis_order not in (ROW_MAJOR, COL_MAJOR):
+            raise ValueError(f"Unknown axis order: {self.axis_order}")
+
+        self.viewBox = plot_item.getViewBox()
+        self.viewBox.sigRangeChanged.connect(self._redrawTile)
+        self.viewBox.sigResized.connect(self._redrawTile)
+
         # # Set the colormap for the heatmap
         # self.plotItem.setLookupTable(pg.colormap.get('CET-D1A').getLookupTable())
 
     def updateData(self, data):
-        self.plotItem.setImage(data.get("z", np.zeros((1, 1))).transpose(), autoLevels=False)
+        """
+        Besides a full "z", data may patch the current image in place:
+            "z_rows": {index: values} replaces rows of z,
+            "z_cols": {index: values} replaces columns of z,
+            "z_region": {"start": (row, col), "values": 2D array} replaces a block,
+            "z_patches": [patch, ...] applies dicts of the keys above in order.
+        Patches are applied after a full z. Indices follow the axis order of z.
+        Only the patched region is copied into the buffer and the histogram and
+        pyramid are updated for it alone.
+        """
+        z = data.get("z", None)
+        if z is not None or self._buffer is None:
+            # A full image comes with its own axes
+            self.x_values = data.get("x", None)
+            self.y_values = data.get("y", None)
+        else:
+            self.x_values = data.get("x", self.x_values)
+            self.y_values = data.get("y", self.y_values)
+        placeholder = z is None and self._buffer is None
+        if placeholder:
+            z = np.zeros((1, 1))
+
+        replaced = False
+        regions = []
+        if z is not None:
+            z = z if self.axis_order == ROW_MAJOR else z.transpose()
+            if (self._buffer is None or self._buffer.shape != z.shape
+                    or self._buffer.dtype != z.dtype):
+                self._buffer = np.array(z, order='C')
+                self.plotItem.histogram.compute(self._buffer)
+                replaced = True
+            else:
+                rows = self._changedRows(z)
+                if rows is not None:
+                    regions.append(self._patch(rows[0], rows[1], 0, z.shape[1], z[rows[0]:rows[1]]))
+        if not placeholder:
+            for patch in data.get("z_patches", [data]):
+                regions.extend(self._applyPatches(patch))
+
+        self.z_values = self._buffer if self.axis_order == ROW_MAJOR else self._buffer.transpose()
+        extent_changed = self._updateExtent()
+        changed = None
+        if regions:
+            changed = (min(r[0] for r in regions), max(r[1] for r in regions),
+                       min(r[2] for r in regions), max(r[3] for r in regions))
+
+        if self._buffer.size <= PYRAMID_THRESHOLD:
+            if self.pyramid is not None or self._tile is not None:
+                self.pyramid, self._tile = None, None
+                extent_changed = True
+            if replaced or changed is not None:
+                self.plotItem.setImage(self._buffer, autoLevels=False)
+            if extent_changed:
+                self._setTransform(0, 0, 1)
+            return
 
-        self.x_values = data.get("x", None)
-        self.y_values = data.get("y", None)
-        self.z_values = data.get("z", None)
+        if self.pyramid is None or replaced:
+            self.pyramid = ImagePyramid(self._buffer)
+        elif changed is not None:
+            # Only the levels above the changed region are recomputed
+            self.pyramid.updateRegion(*changed)
+        elif not extent_changed:
+            return
+        self._tile = None
+        self._redrawTile()
+
+    def _changedRows(self, z):
+        """
+        Returns:
+            tuple: (start, stop) of the rows in which z differs from the buffer,
+                   None if it does not differ.
+        """
+        with np.errstate(invalid='ignore'):
+            same = (z == self._buffer) | (np.isnan(z) & np.isnan(self._buffer))
+        changed = np.flatnonzero(~same.all(axis=1))
+        if not changed.size:
+            return None
+        return changed[0], changed[-1] + 1
+
+    def _applyPatches(self, data):
+        row_major = self.axis_order == ROW_MAJOR
+        rows_key, cols_key = ("z_rows", "z_cols") if row_major else ("z_cols", "z_rows")
+        height, width = self._buffer.shape
+        regions = []
+
+        # Keys arrive as strings from the live socket
+        for index, values in data.get(rows_key, {}).items():
+            index = int(index)
+            regions.append(self._patch(index, index + 1, 0, width, values))
+
+        for index, values in data.get(cols_key, {}).items():
+            index = int(index)
+            regions.append(self._patch(0, height, index, index + 1,
+                                       np.asarray(values).reshape(-1, 1)))
+
+        region = data.get("z_region", None)
+        if region is not None:
+            values = np.asarray(region["values"])
+            row, col = region["start"]
+            if not row_major:
+                values, row, col = values.transpose(), col, row
+            regions.append(self._patch(row, row + values.shape[0],
+                                       col, col + values.shape[1], values))
+        return regions
+
+    def _patch(self, row_start, row_stop, col_start, col_stop, values):
+        target = self._buffer[row_start:row_stop, col_start:col_stop]
+        old = target.copy()
+        target[...] = values
+        if not self.plotItem.histogram.patch(old, target):
+            self.plotItem.histogram.compute(self._buffer)
+        return row_start, row_stop, col_start, col_stop
+
+    def _updateExtent(self):
+        """
+        Recompute scale and offset of the image, only if x, y or the shape changed.
+        """
+        rows, cols = self._buffer.shape
+        extent = (None if self.x_values is None else (self.x_values[0], self.x_values[-1]),
+                  None if self.y_values is None else (self.y_values[0], self.y_values[-1]),
+                  rows, cols)
+        if extent == self._extent:
+            return False
+        self._extent = extent
 
         if self.x_values is not None:
-            scale_x = (self.x_values[-1] - self.x_values[0]) / self.z_values.shape[1]
+            scale_x = (self.x_values[-1] - self.x_values[0]) / cols
             translate_x = self.x_values[0]
         else:
             scale_x = 1
             translate_x = 0
 
         if self.y_values is not None:
-            scale_y = (self.y_values[-1] - self.y_values[0]) / self.z_values.shape[0]
+            scale_y = (self.y_values[-1] - self.y_values[0]) / rows
             translate_y = self.y_values[0]
         else:
             scale_y = 1
             translate_y = 0
 
+        self._scale = (scale_x, scale_y)
+        self._translate = (translate_x, translate_y)
+        return True
+
+    def _visibleRegion(self):
+        """
+        Visible (start, stop) rows and columns of z, clipped to the image.
+        """
+        (x0, x1), (y0, y1) = self.viewBox.viewRange()
+        cols = sorted(((x0 - self._translate[0]) / (self._scale[0] or 1),
+                       (x1 - self._translate[0]) / (self._scale[0] or 1)))
+        rows = sorted(((y0 - self._translate[1]) / (self._scale[1] or 1),
+                       (y1 - self._translate[1]) / (self._scale[1] or 1)))
+        height, width = self.pyramid.shape
+        return (tuple(np.clip(rows, 0, height)), tuple(np.clip(cols, 0, width)))
+
+    def _redrawTile(self, *args):
+        if self.pyramid is None:
+            return
+
+        if self.viewBox.autoRangeEnabled()[0] or self.viewBox.autoRangeEnabled()[1]:
+            # Auto ranging shows the whole image, drawn from the level fitting the view
+            height, width = self.pyramid.shape
+            rows, cols = (0, height), (0, width)
+        else:
+            rows, cols = self._visibleRegion()
+        if rows[1] <= rows[0] or cols[1] <= cols[0]:
+            return  # Image is out of view
+
+        level = self.pyramid.levelFor(rows, cols, (self.viewBox.height(), self.viewBox.width()))
+        if (self._tile is not None and self._tile[0] == level
+                and self.pyramid.covers(level, self._tile[1], rows, cols)):
+            return
+
+        tile = self.pyramid.tile(level, rows, cols)
+        image = self.pyramid.levels[level][tile[0]:tile[1], tile[2]:tile[3]]
+        self.plotItem.setImage(image, autoLevels=False)
+        factor = 2 ** level
+        self._setTransform(tile[0] * factor, tile[2] * factor, factor)
+        self._tile = (level, tile)
+
+    def _setTransform(self, row, col, factor):
         transform = QtGui.QTransform()
-        transform.translate(translate_x, translate_y)
-        transform.scale(scale_x, scale_y)
+        transform.translate(self._translate[0] + col * self._scale[0],
+                            self._translate[1] + row * self._scale[1])
+        transform.scale(self._scale[0] * factor, self._scale[1] * factor)
         self.plotItem.setTransform(transform)
 
     def setVisible(self, visible: bool):
@@ -195,8 +659,18 @@ class MultiHistogramLUTItem(pg.HistogramLUTItem):
 
         self.gradient.loadPreset('viridis')
 
-        self.sigLevelsChanged.connect(self.updateHistogram)
-        self.gradient.sigGradientChanged.connect(self.updateHistogram)
+        # One LUT shared by all images, rebuilt only when the gradient changes
+        self._lut : np.ndarray = None
+
+        # Level and gradient changes arriving together are applied at once
+        self._lutTimer = QtCore.QTimer()
+        self._lutTimer.setSingleShot(True)
+        self._lutTimer.setInterval(0)
+        self._lutTimer.timeout.connect(self._applyLUT)
+
+        # Levels and gradient only change the colours, the histogram stays
+        self.sigLevelsChanged.connect(self.updateLUT)
+        self.gradient.sigGradientChanged.connect(self._gradientChanged)
 
         if images:
             self.addImages(*images)
@@ -208,31 +682,63 @@ class MultiHistogramLUTItem(pg.HistogramLUTItem):
         for im in ims:
             self.images.append(im)
         self.updateHistogram()
+        self.updateLUT()
         self._pending_region_change = True
 
     def updateHistogram(self):
-        arrays = []
+        # Maps keep the histogram of their image up to date, other images
+        # are histogrammed here
+        histograms = []
         for im in self.images:
-            data = getattr(im, 'image', None)
-            if data is not None:
-                arrays.append(data.ravel())
-        if not arrays:
+            histogram = getattr(im, 'histogram', None)
+            if histogram is None:
+                data = getattr(im, 'image', None)
+                if data is None:
+                    continue
+                histogram = ImageHistogram()
+                histogram.compute(data)
+            if histogram.counts is not None:
+                histograms.append(histogram)
+        if not histograms:
             return
-        
-        all_data = np.hstack(arrays)
 
-        counts, edges = np.histogram(all_data, bins='scott') #256)
+        edges = np.linspace(min(h.edges[0] for h in histograms),
+                            max(h.edges[-1] for h in histograms),
+                            HISTOGRAM_BINS + 1)
+        counts = sum(np.histogram(h.centers, bins=edges, weights=h.counts)[0]
+                     for h in histograms)
+        # Patches of sampled histograms are estimates and can dip below zero
+        counts = np.maximum(counts, 0)
 
         centers = (edges[:-1] + edges[1:]) * 0.5
 
         self.plot.setData(centers, counts)
 
+    def _gradientChanged(self):
+        self._lut = None
         self.updateLUT()
 
+    def lookupTable(self):
+        if self._lut is None:
+            self._lut = self.gradient.getLookupTable(nPts=256, alpha=True)
+        return self._lut
+
     def updateLUT(self):
+        """
+        Apply levels and LUT to all images once control returns to the event
+        loop, so a burst of level changes (dragging the region) costs one
+        update of each image.
+        """
+        if not self._lutTimer.isActive():
+            self._lutTimer.start()
+
+    def _applyLUT(self):
+        levels = self.getLevels()
+        lut = self.lookupTable()
         for im in self.images:
-            im.setLevels(self.getLevels())
-            im.setLookupTable(self.gradient.getLookupTable(nPts=256, alpha=True))
+            # Both are no-ops for an image that already has this LUT and these levels
+            im.setLookupTable(lut)
+            im.setLevels(levels)
 
     def updateLUTRegion(self):
         try:
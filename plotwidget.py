@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import pyqtgraph as pg
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QTabWidget, QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget, QProgressBar, QFormLayout, QLabel, QLineEdit, QDialog
 import numpy as np
 import sys
@@ -7,6 +8,7 @@ import cmasher as cmr
 
 from pyqtgraph.dockarea import DockArea, Dock
 from graph import Graph
+from live_protocol import merge_part_data
 
 MAP_LAYER = -3
 LINE_LAYER = -2
@@ -15,6 +17,12 @@ SCATTER_LAYER = -1
 WIDTH = 3
 NCOLORS = 7
 
+# Repaints per second PlotWidget allows at most
+DEFAULT_MAX_FPS = 30
+
+# Interval in ms at which updates held back for hidden graphs are retried
+HIDDEN_RETRY_MS = 250
+
 colors = []
 cmap_map = pg.colormap.get('CET-D2')
 
@@ -36,12 +44,26 @@ class PlotWidget(QWidget):
     def __init__(self,
                  layout: dict,
                  progress_bar: bool = False,
-                 metadata: dict = None):
+                 metadata: dict = None,
+                 max_fps: float = DEFAULT_MAX_FPS):
 
         super().__init__()
         self.graphs = {}
         self._buildWidget(layout, metadata)
 
+        # Updates are collected and pushed into the graphs at most max_fps
+        # times per second, each graph is touched once per frame
+        self._pendingGraphs = {}
+        self._pendingParts = {}
+        self._pendingPack = {}
+        self._frameTimer = QTimer(self)
+        self._frameTimer.setSingleShot(True)
+        self._frameTimer.timeout.connect(self._renderFrame)
+        self.setMaxFps(max_fps)
+
+    def setMaxFps(self, max_fps: float):
+        self.frameInterval = max(int(1000 / max_fps), 1)
+
     def _buildWidget(self, layout: dict, metadata: dict = None):
         self.graphs = {}
         vertical_layout = QVBoxLayout(self)
@@ -49,7 +71,8 @@ class PlotWidget(QWidget):
         self.progressBar = QProgressBar(self)
         self.progressBar.setValue(0)
         self.progressBar.setMaximum(layout.get("n_iterations", 1_000_000))
-        self.progressBar.setFormat("{}/{}".format(0, layout.get("n_iterations", 1_000_000)))
+        # Filled in by Qt with the current value and maximum on every change
+        self.progressBar.setFormat("%v/%m")
         vertical_layout.addWidget(self.progressBar)
 
         
@@ -136,15 +159,77 @@ class PlotWidget(QWidget):
     #             layout[key]['loc'][2],
     #         
 
-    def updateData(self, data_pack):
-        for key, graph in self.graphs.items():
-            graph.updateData(
-                data_pack.get(key, {})
-            )
-        self.progressBar.setValue(data_pack.get("iter", 0))
+    def updateData(self, data_pack, dirty = None):
+        """
+        Queue new data for the graphs, drawn with the next frame.
+
+        dirty maps graph names to the set of changed parts (None for all parts),
+        as produced by backend.dirty_parts. Graphs missing from it are not
+        touched. Without dirty everything is updated. Updates arriving before
+        the next frame are merged, so every plot item is set once per frame.
+        """
+        for key in self.graphs:
+            if dirty is not None and key not in dirty:
+                continue
+            parts = None if dirty is None else dirty[key]
+            self._queueGraph(key, data_pack.get(key, {}), parts)
+
+        if dirty is None or "iter" in dirty:
+            self._pendingPack["iter"] = data_pack.get("iter", 0)
+        if "n_iterations" in data_pack and (dirty is None or "n_iterations" in dirty):
+            self._pendingPack["n_iterations"] = data_pack["n_iterations"]
 
         metaData = data_pack.get('metadata', None)
-
+        if metaData is not None and (dirty is None or "metadata" in dirty):
+            self._pendingPack["metadata"] = metaData
+
+        # A retry for hidden graphs must not hold back the visible ones
+        if (not self._frameTimer.isActive()
+                or self._frameTimer.remainingTime() > self.frameInterval):
+            self._frameTimer.start(self.frameInterval)
+
+    def _queueGraph(self, key, graph_data, parts):
+        if key not in self._pendingGraphs:
+            self._pendingGraphs[key] = graph_data
+            self._pendingParts[key] = None if parts is None else set(parts)
+            return
+
+        merged = dict(self._pendingGraphs[key])
+        for part in (graph_data if parts is None else parts):
+            if part in graph_data:
+                merged[part] = merge_part_data(merged.get(part), graph_data[part])
+        self._pendingGraphs[key] = merged
+
+        queued = self._pendingParts[key]
+        self._pendingParts[key] = None if queued is None or parts is None else queued | set(parts)
+
+    @staticmethod
+    def _isShown(widget):
+        """
+        False for widgets in hidden or background docks, minimized windows and
+        floating docks moved off every screen.
+        """
+        if not widget.isVisible() or widget.visibleRegion().isEmpty():
+            return False
+        window = widget.window()
+        if window.isMinimized():
+            return False
+        screen = window.screen()
+        return screen is None or screen.geometry().intersects(window.frameGeometry())
+
+    def _renderFrame(self):
+        for key in list(self._pendingGraphs):
+            graph = self.graphs[key]
+            if not self._isShown(graph):
+                continue  # Kept, drawn with the first frame it is shown in
+            graph.updateData(self._pendingGraphs.pop(key), parts=self._pendingParts.pop(key))
+
+        if "n_iterations" in self._pendingPack:
+            self.progressBar.setMaximum(self._pendingPack.pop("n_iterations"))
+        if "iter" in self._pendingPack:
+            self.progressBar.setValue(self._pendingPack.pop("iter"))
+
+        metaData = self._pendingPack.pop("metadata", None)
         if metaData is not None:
             for attribute, value in metaData.items():
                 self.lineEdits[attribute].setText(value)
@@ -153,6 +238,9 @@ class PlotWidget(QWidget):
         #     data_pack.get("n_iterations", 1_000_000)
         # ))
 
+        if self._pendingGraphs:
+            self._frameTimer.start(HIDDEN_RETRY_MS)
+
 if __name__ == "__main__":
     import sys
     from PyQt6.QtWidgets import QApplication, QMainWindow
@@ -0,0 +1,267 @@
+import time
+import threading
+import numpy as np
+import zmq
+
+from live_protocol import (
+    SessionEncoder, SharedRing, send_data, inline_paths, merge_part_data, APPEND_MODE,
+)
+
+# Seconds between sends while the receivers keep up, and the longest pause
+# between sends when they do not (or nobody acknowledges at all)
+MIN_INTERVAL = 0.05
+MAX_INTERVAL = 1.0
+
+# Frames a publisher may have in flight without an acknowledgement
+CREDIT_WINDOW = 4
+
+# Factors applied to the send interval on a stall and on an acknowledgement
+BACKOFF = 2.0
+SPEEDUP = 0.8
+
+# Frames queued by the PUB socket, the receivers conflate queued frames
+SEND_HWM = 1000
+
+
+class Publisher:
+    '''
+    Producer side of the live plot: publishes a layout and its data to the
+    viewers in live_plot_widget.
+
+    Values are handed over with update() (newest value wins) and append()
+    (points are batched until the next send, for parts in append mode). Only
+    what was handed over is referenced, the measurement data is never copied
+    as a whole. Arrays are sent without copying, so they must not be modified
+    in place after they were passed to update().
+
+    With an ack endpoint the publisher is credit based: every frame costs one
+    credit, receivers return credits when they got frames. The send interval
+    shrinks while credits come back and grows when they run out, so a slow
+    receiver gets fewer, larger frames instead of a growing queue. Without
+    credit a frame still goes out every max_interval, so new viewers catch up.
+
+    With shared_memory, large arrays are written into a SharedRing of that
+    many bytes and only their position is sent, for viewers on the same host.
+    Batches of append mode parts and HeatMap patches are always sent in the
+    message itself.
+    '''
+
+    def __init__(self,
+                 endpoint,
+                 layout,
+                 topic = b'',
+                 bind = True,
+                 ack_endpoint = None,
+                 ack_address = None,
+                 min_interval = MIN_INTERVAL,
+                 max_interval = MAX_INTERVAL,
+                 credit_window = CREDIT_WINDOW,
+                 shared_memory = None,
+                 context = None):
+        """
+        Parameters:
+            endpoint (str): Data endpoint, e.g. "tcp://*:5555".
+            layout (dict): Layout of the graphs, see plotwidget.PlotWidget.
+            topic (bytes): Topic of this stream, viewers open one tab per topic.
+            bind (bool): Bind the endpoint, or connect to a viewer that binds it.
+            ack_endpoint (str): Endpoint bound for acknowledgements, e.g.
+                                "tcp://*:5565". None disables credit control.
+            ack_address (str): Address receivers connect to for acknowledgements,
+                               defaults to ack_endpoint with "*" as "localhost".
+            min_interval (float): Shortest time between sends in seconds.
+            max_interval (float): Longest time between sends in seconds.
+            credit_window (int): Frames in flight without acknowledgement.
+            shared_memory (int): Size in bytes of a SharedRing for large arrays.
+                                 Only for viewers on the same host.
+        """
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, SEND_HWM)
+        if bind:
+            self.socket.bind(endpoint)
+        else:
+            self.socket.connect(endpoint)
+
+        self.ack_socket = None
+        self.ack_address = None
+        if ack_endpoint is not None:
+            self.ack_socket = self.context.socket(zmq.PULL)
+            self.ack_socket.bind(ack_endpoint)
+            self.ack_address = ack_address or ack_endpoint.replace('*', 'localhost')
+
+        self.ring = None
+        if shared_memory is not None:
+            self.ring = SharedRing(size=shared_memory, create=True)
+
+        self.topic = topic
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.credit_window = credit_window
+        self.interval = min_interval
+        self.credit = credit_window
+
+        self.session = SessionEncoder()
+        self._lock = threading.Lock()
+        self._layout = layout
+        self._fields = {}
+        self._parts = {}
+        self._batches = {}
+        # Parts handed over with update() since the last send
+        self._dirty = set()
+        self._changed = False
+        self._last_send = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def setLayout(self, layout):
+        with self._lock:
+            self._layout = layout
+            self._parts = {}
+            self._batches = {}
+            self._dirty = set()
+            self._changed = True
+
+    def set(self, key, value):
+        """
+        Set a top-level field of the data pack, e.g. "iter" or "metadata".
+        """
+        with self._lock:
+            self._fields[key] = value
+            self._changed = True
+
+    def update(self, graph, part, **values):
+        """
+        Replace the data of a part, e.g. update("Plot1", "part1", x=x, y=y).
+
+        Values not sent yet are merged as the viewer merges frames: HeatMap
+        patches (z_rows, z_cols, z_region) are queued in order, everything
+        else is replaced.
+        """
+        with self._lock:
+            parts = self._parts.setdefault(graph, {})
+            if (graph, part) in self._dirty:
+                values = merge_part_data(parts[part], values)
+            parts[part] = values
+            self._dirty.add((graph, part))
+            self._changed = True
+
+    def append(self, graph, part, **values):
+        """
+        Add points to a part in append mode. Points are batched until the next
+        send, which carries all of them in one array per key.
+        Points are sent once, a viewer that misses the frame never gets them.
+        """
+        part_config = self._layout[graph]['content'][part]
+        if part_config.get('mode') != APPEND_MODE:
+            raise ValueError(f"{graph}/{part} is not in {APPEND_MODE} mode")
+
+        with self._lock:
+            batch = self._batches.setdefault((graph, part), {})
+            for key, value in values.items():
+                batch.setdefault(key, []).append(np.atleast_1d(value))
+            self._changed = True
+
+    def _takePack(self):
+        with self._lock:
+            data = {graph: dict(parts) for graph, parts in self._parts.items()}
+            for (graph, part), batch in self._batches.items():
+                data.setdefault(graph, {})[part] = {key: np.concatenate(chunks)
+                                                    for key, chunks in batch.items()}
+            self._batches = {}
+            dirty, self._dirty = self._dirty, set()
+            self._changed = False
+            return dict(self._fields, layout=self._layout, data=data), dirty
+
+    def _collectAcks(self):
+        if self.ack_socket is None:
+            return
+        while True:
+            try:
+                _, count = self.ack_socket.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.credit = min(self.credit_window, self.credit + int(count))
+            self.interval = max(self.min_interval, self.interval * SPEEDUP)
+
+    def publish(self, force = False):
+        """
+        Send the pending changes if the rate and credit allow it.
+
+        Parameters:
+            force (bool): Send regardless of interval and credit.
+
+        Returns:
+            bool: True if a frame was sent.
+        """
+        self._collectAcks()
+        now = time.monotonic()
+        since_last = None if self._last_send is None else now - self._last_send
+
+        if not force:
+            # The key frame timer of the session needs a send even without changes
+            if not self._changed and since_last is not None and since_last < self.max_interval:
+                return False
+            if since_last is not None and since_last < self.interval:
+                return False
+            if self.ack_socket is not None and self.credit <= 0:
+                if since_last is not None and since_last < self.max_interval:
+                    return False
+                # Nobody acknowledged in time, send slower from now on
+                self.interval = min(self.max_interval, self.interval * BACKOFF)
+
+        # Only parts updated since the last send are hashed, key frames still
+        # carry all of them
+        pack, dirty = self._takePack()
+        header, payload = self.session.encode(pack, changed=dirty)
+        if self.ack_address is not None:
+            header['ack'] = self.ack_address
+        try:
+            send_data(self.socket, payload, topic=self.topic, header=header,
+                      flags=zmq.NOBLOCK, ring=self.ring,
+                      inline=inline_paths(pack['layout'], payload['data']))
+        except zmq.Again:
+            return False
+
+        self.credit = max(self.credit - 1, 0)
+        self._last_send = now
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.publish()
+            if self.ack_socket is not None:
+                # Wake up early for acknowledgements
+                self.ack_socket.poll(int(self.interval * 1000))
+            else:
+                self._stop_event.wait(self.interval)
+
+    def start(self):
+        """
+        Publish from a background thread. The sockets are then used by that
+        thread only, do not call publish() yourself.
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.publish(force=True)
+        self.socket.close(linger=1000)
+        if self.ack_socket is not None:
+            self.ack_socket.close(linger=0)
+        if self.ring is not None:
+            self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
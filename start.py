@@ -2,7 +2,7 @@ import sys, os
 # sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from PyQt6.QtWidgets import QApplication
 from PyQt6.QtGui import QIcon
-from PyQt6.QtCore import QSize
+from PyQt6.QtCore import QSize, Qt
 from gui import MainWindow
 from backend import CoreBackend
 
@@ -24,6 +24,8 @@ if __name__ == "__main__":
     )
 
     backend = CoreBackend()
+    # Direct, a queued call would run in the backend thread and wait on itself
+    app.aboutToQuit.connect(backend.shutdown, Qt.ConnectionType.DirectConnection)
 
     main_window = MainWindow(backend)
     
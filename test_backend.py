@@ -0,0 +1,150 @@
+import threading
+import h5py
+import numpy as np
+import pytest
+from PyQt6.QtCore import QCoreApplication, QMetaObject, Qt
+
+import backend as backend_module
+from backend import CoreBackend
+from input_output import DataPacket, handle_pool
+
+
+def write_source(path, x):
+    # As another process would, without the read handle of this one
+    handle_pool.discard(path)
+    DataPacket._save_data_to_hdf5(str(path), {'Plot': {'line': {'x': x}}})
+
+
+def cut_in_half(path):
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    return data
+
+
+@pytest.fixture
+def backend(tmp_path):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    backend = CoreBackend()
+    backend.sourceFolder = str(tmp_path)
+    yield backend
+    backend.shutdown()
+
+
+def test_half_written_source_is_added_once_complete(backend, tmp_path):
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    data = cut_in_half(path)
+
+    backend._addSource(str(path))
+    assert str(path) not in backend.data_packets
+    assert str(path) in backend._pending
+
+    # Retried as soon as the file changed
+    path.write_bytes(data)
+    refresh(backend)
+    assert str(path) in backend.data_packets
+    assert str(path) not in backend._pending
+    assert str(path) in backend.snapshots
+
+
+def test_half_written_refresh_keeps_last_snapshot(backend, tmp_path):
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    backend._addSource(str(path))
+    source, _, snapshot = backend._loadPacket(str(path))
+    backend.snapshots[source] = snapshot
+
+    write_source(path, np.arange(20))
+    cut_in_half(path)
+    assert backend._loadPacket(str(path)) == (str(path), None, None)
+    assert backend.snapshots[source]['Plot']['line']['x'].size == 10
+
+
+def raise_h5py_key_error(path):
+    with h5py.File(path, 'r') as f:
+        f['missing']
+
+
+def raise_h5py_os_error(path):
+    h5py.File(str(path) + '.missing', 'r')
+
+
+@pytest.mark.parametrize('fail', [raise_h5py_key_error, raise_h5py_os_error])
+def test_h5py_errors_while_writing_are_caught(backend, tmp_path, monkeypatch, fail):
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    backend._addSource(str(path))
+
+    monkeypatch.setattr(backend.data_packets[str(path)], 'update', lambda: fail(path))
+    assert backend._loadPacket(str(path)) == (str(path), None, None)
+
+
+@pytest.mark.parametrize('error', [RuntimeError, KeyError])
+def test_errors_outside_h5py_are_raised(backend, tmp_path, monkeypatch, error):
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    backend._addSource(str(path))
+
+    def update():
+        raise error("bug")
+    monkeypatch.setattr(backend.data_packets[str(path)], 'update', update)
+    with pytest.raises(error):
+        backend._loadPacket(str(path))
+
+
+def refresh(backend):
+    QMetaObject.invokeMethod(backend, "updateData", Qt.ConnectionType.BlockingQueuedConnection)
+
+
+def test_broken_source_is_reported_once_and_retried_when_changed(backend, tmp_path, monkeypatch, capsys):
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    refresh(backend)
+
+    calls = []
+    def update():
+        calls.append(path)
+        raise OSError("truncated file")
+    monkeypatch.setattr(backend.data_packets[str(path)], 'update', update)
+
+    backend._markDirty(str(path))
+    refresh(backend)
+    refresh(backend)
+    assert len(calls) == 1
+
+    write_source(path, np.arange(20))
+    refresh(backend)
+    assert len(calls) == 2
+    assert capsys.readouterr().out.count("Could not refresh") == 1
+
+
+def test_new_sources_are_opened_in_parallel_workers(backend, tmp_path, monkeypatch):
+    paths = [tmp_path / f'run{i}.h5' for i in range(3)]
+    for path in paths:
+        write_source(path, np.arange(10))
+
+    threads = []
+    def open_packet(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return DataPacket(*args, **kwargs)
+    monkeypatch.setattr(backend_module, 'DataPacket', open_packet)
+
+    refresh(backend)
+    assert set(backend.snapshots) == {str(path) for path in paths}
+    assert len(threads) == 3
+    assert all(thread.name.startswith('ThreadPoolExecutor') for thread in threads)
+
+
+def test_shutdown_closes_pooled_handles(tmp_path):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    backend = CoreBackend()
+    backend.sourceFolder = str(tmp_path)
+    path = tmp_path / 'run.h5'
+    write_source(path, np.arange(10))
+    refresh(backend)
+    with handle_pool.open(path) as f:
+        file_id = f.id
+
+    backend.shutdown()
+    assert not file_id.valid
+    assert str(path) not in handle_pool._handles
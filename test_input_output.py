@@ -0,0 +1,162 @@
+import h5py
+import numpy as np
+import pytest
+from contextlib import contextmanager
+
+import input_output
+from input_output import DataPacket, handle_pool, GENERATION_ATTR
+
+
+def write_mixed_source(path):
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('M/map/z', data=np.zeros(2))
+        f.create_dataset('iter', data=0)
+        f.create_dataset('P/trace/x', data=np.arange(3.0), chunks=(4,), maxshape=(None,))
+
+
+def test_append_only_rereads_fixed_shape_datasets(tmp_path):
+    path = tmp_path / 'run.h5'
+    write_mixed_source(path)
+    packet = DataPacket(source=str(path), append_only=True)
+
+    # As another process would, without the read handle of this one
+    handle_pool.discard(path)
+    with h5py.File(path, 'a') as f:
+        f['M/map/z'][0] = 7
+        f['iter'][()] = 1
+        f['P/trace/x'].resize((5,))
+        f['P/trace/x'][3:] = [3, 4]
+
+    assert packet.update() == {'/M/map/z', '/iter', '/P/trace/x'}
+    assert packet['M']['map']['z'].tolist() == [7, 0]
+    assert packet['iter'] == 1
+    assert packet['P']['trace']['x'].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_update_slice_leaves_snapshots_alone(tmp_path):
+    packet = DataPacket(data={'G': {'m': {'z': np.zeros((2, 2))}}}, source=tmp_path / 'run.h5')
+    packet.save_data()
+    snapshot = packet.snapshot()
+
+    packet.update_slice('G/m/z', np.s_[0], 5.0)
+    assert snapshot['G']['m']['z'].tolist() == [[0, 0], [0, 0]]
+    assert packet['G']['m']['z'].tolist() == [[5, 5], [0, 0]]
+    packet.close()
+
+
+def test_append_after_copied_patch_keeps_the_patch(tmp_path):
+    packet = DataPacket(data={'P': {}}, source=tmp_path / 'run.h5')
+    packet.append('P/trace/x', np.arange(3.0))
+    snapshot = packet.snapshot()
+
+    packet.update_slice('P/trace/x', np.s_[0], 9.0)
+    packet.append('P/trace/x', [3.0])
+    assert snapshot['P']['trace']['x'].tolist() == [0, 1, 2]
+    assert packet['P']['trace']['x'].tolist() == [9, 1, 2, 3]
+    packet.close()
+
+
+def write_tracked_source(path):
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('G')
+        group.attrs['unit'] = 'V'
+        for name in ('line/x', 'line/y', 'map/z'):
+            group.create_dataset(name, data=np.zeros(3), chunks=(4,), maxshape=(None,))
+            group[name].attrs[GENERATION_ATTR] = 0
+        f.create_dataset('iter', data=0)
+
+
+@contextmanager
+def outside_writer(path):
+    # As another process would, without the read handle of this one
+    handle_pool.discard(path)
+    with h5py.File(path, 'a') as f:
+        yield f
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_update_returns_only_what_changed(tmp_path, lazy):
+    path = tmp_path / 'run.h5'
+    write_tracked_source(path)
+    packet = DataPacket(source=str(path), lazy=lazy)
+    assert packet.update() == set()
+
+    with outside_writer(path) as f:
+        f['G/map/z'][0] = 1
+        f['G/map/z'].attrs[GENERATION_ATTR] = 1
+    assert packet.update() == {'/G/map/z', '/iter'}
+
+    with outside_writer(path) as f:
+        f['G/line/x'].resize((5,))
+        f['G/line/x'][3:] = [3, 4]
+    assert packet.update() == {'/G/line/x', '/iter'}
+
+    with outside_writer(path) as f:
+        f['G'].attrs['unit'] = 'mV'
+        del f['G/line/y']
+    assert packet.update() == {'/G/metadata', '/G/line/y', '/iter'}
+    assert packet['G']['line']['x'].tolist() == [0, 0, 0, 3, 4]
+    assert 'y' not in packet['G']['line']
+
+
+def test_update_keeps_unchanged_arrays_in_place(tmp_path):
+    path = tmp_path / 'run.h5'
+    write_tracked_source(path)
+    packet = DataPacket(source=str(path))
+    line = packet['G']['line']['y']
+
+    with outside_writer(path) as f:
+        f['G/map/z'].attrs[GENERATION_ATTR] = 1
+    packet.update()
+    assert packet['G']['line']['y'] is line
+
+
+def test_lazy_snapshot_loads_datasets_once_looked_up(tmp_path):
+    path = tmp_path / 'run.h5'
+    write_tracked_source(path)
+    packet = DataPacket(source=str(path), lazy=True)
+
+    snapshot = packet.snapshot()
+    assert 'z' not in snapshot['G']['map']
+    with pytest.raises(KeyError):
+        snapshot['G']['map']['z']
+    assert packet.newly_wanted == {'/G/map/z'}
+
+    snapshot = packet.snapshot()
+    assert not packet.snapshot_outdated
+    assert snapshot['G']['map']['z'].tolist() == [0, 0, 0]
+    assert list(snapshot['G']['line']) == []
+
+
+def test_lazy_snapshot_reads_only_changed_datasets(tmp_path, monkeypatch):
+    path = tmp_path / 'run.h5'
+    write_tracked_source(path)
+    # Too small to keep anything, every read would go to the disk
+    monkeypatch.setattr(input_output.dataset_cache, 'max_bytes', 1)
+    reads = []
+    read_dataset = DataPacket._read_dataset
+    def counted_read(item):
+        reads.append(item.name)
+        return read_dataset(item)
+    monkeypatch.setattr(DataPacket, '_read_dataset', staticmethod(counted_read))
+
+    packet = DataPacket(source=str(path), lazy=True)
+    for name in ('/G/map/z', '/G/line/x'):
+        packet._wanted.add(name)
+    packet.snapshot()
+    assert sorted(reads) == ['/G/line/x', '/G/map/z']
+
+    for i in range(1, 4):
+        with outside_writer(path) as f:
+            f['iter'][()] = i
+        assert packet.update() == {'/iter'}
+        packet.snapshot()
+    assert sorted(reads) == ['/G/line/x', '/G/map/z']
+
+    with outside_writer(path) as f:
+        f['G/map/z'][0] = 1
+        f['G/map/z'].attrs[GENERATION_ATTR] = 1
+    packet.update()
+    snapshot = packet.snapshot()
+    assert reads.count('/G/map/z') == 2 and reads.count('/G/line/x') == 1
+    assert snapshot['G']['map']['z'].tolist() == [1, 0, 0]
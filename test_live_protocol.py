@@ -0,0 +1,384 @@
+import time
+
+import numpy as np
+import pytest
+import zmq
+
+from live_protocol import (
+    recv_data, send_data, merge_part_data, SharedRing, StaleFrame, PATCHES_KEY,
+    SessionEncoder, SessionDecoder, Conflator, LAYOUT_FRAME, DATA_FRAME, APPEND_MODE,
+    inline_paths,
+)
+from publisher import Publisher, BACKOFF, SPEEDUP
+
+
+@pytest.fixture
+def sockets():
+    context = zmq.Context.instance()
+    sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+    address = f"inproc://live-{id(sender)}"
+    receiver.bind(address)
+    sender.connect(address)
+    yield sender, receiver
+    sender.close(linger=0)
+    receiver.close(linger=0)
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(size=2**20, create=True)
+    yield ring
+    ring.close()
+
+
+def round_trip(sockets, data, ring = None, **kwargs):
+    sender, receiver = sockets
+    send_data(sender, data, topic=b'run', header={'iter': 3}, ring=ring, **kwargs)
+    rings = {}
+    try:
+        return recv_data(receiver, rings=rings)
+    finally:
+        for attached in rings.values():
+            attached.close()
+
+
+def test_arrays_round_trip_with_dtype_and_shape(sockets):
+    data = {'G': {'p': {'x': np.arange(6, dtype=np.int16).reshape(2, 3),
+                        'y': np.linspace(0, 1, 4)[::2],
+                        'label': 'trace',
+                        'n': np.float32(2.5)}}}
+    topic, header, received = round_trip(sockets, data)
+
+    assert topic == b'run'
+    assert header == {'iter': 3}
+    part = received['G']['p']
+    assert part['x'].dtype == np.int16 and part['x'].tolist() == [[0, 1, 2], [3, 4, 5]]
+    assert part['y'].tolist() == [0, 2 / 3]
+    assert part['label'] == 'trace' and part['n'] == 2.5
+    assert not part['x'].flags.writeable
+
+
+def test_zero_dimensional_arrays_keep_their_shape(sockets):
+    _, _, received = round_trip(sockets, {'iter': np.array(7), 'v': np.array([7])})
+
+    assert received['iter'].shape == ()
+    assert received['iter'] == 7
+    assert received['v'].shape == (1,)
+
+
+def test_z_patches_round_trip_in_order(sockets):
+    patches = [{'z_rows': {2: np.ones(3)}},
+               {'z_region': {'start': (1, 0), 'values': np.full((1, 3), 2.0)}}]
+    _, _, received = round_trip(sockets, {'G': {'m': {PATCHES_KEY: patches}}})
+
+    received = received['G']['m'][PATCHES_KEY]
+    # JSON turns row indices into strings, Map.updateData converts them back
+    assert received[0]['z_rows']['2'].tolist() == [1, 1, 1]
+    assert received[1]['z_region']['start'] == [1, 0]
+    assert received[1]['z_region']['values'].tolist() == [[2, 2, 2]]
+
+
+def test_large_arrays_go_through_the_ring(sockets, ring):
+    large, small = np.arange(2**14, dtype=np.float64), np.arange(4)
+    _, header, received = round_trip(sockets, {'large': large, 'small': small}, ring=ring)
+
+    assert header['ring'] == ring.name
+    assert ring.written >= large.nbytes
+    assert np.array_equal(received['large'], large)
+    assert np.array_equal(received['small'], small)
+
+
+def test_inline_paths_stay_out_of_the_ring(sockets, ring):
+    large = np.arange(2**14, dtype=np.float64)
+    _, _, received = round_trip(sockets, {'data': {'G': {'p': {'x': large}}}}, ring=ring,
+                                inline={('data', 'G', 'p')})
+
+    assert ring.written == 0
+    assert np.array_equal(received['data']['G']['p']['x'], large)
+
+
+def test_overwritten_ring_slot_is_stale(ring):
+    first = ring.put(np.zeros(2**16))
+    reader = SharedRing(ring.name)
+    try:
+        assert reader.get(first, '<f8', (2**16,)).sum() == 0
+        for _ in range(3):
+            ring.put(np.ones(2**16))
+        with pytest.raises(StaleFrame):
+            reader.get(first, '<f8', (2**16,))
+    finally:
+        reader.close()
+
+
+def test_merged_patches_apply_in_order():
+    older = {'z_rows': {0: np.zeros(2)}, 'x': np.arange(2)}
+    newer = {'z_region': {'start': (0, 0), 'values': np.ones((1, 1))}, 'x': np.arange(3)}
+    merged = merge_part_data(merge_part_data(older, newer), {'z_cols': {1: np.ones(2)}})
+
+    assert [list(patch) for patch in merged[PATCHES_KEY]] == [['z_rows'], ['z_region'], ['z_cols']]
+    assert merged['x'].tolist() == [0, 1, 2]
+
+
+def test_full_image_replaces_merged_patches():
+    merged = merge_part_data({'z_rows': {0: np.zeros(2)}}, {'z': np.ones((2, 2))})
+
+    assert PATCHES_KEY not in merged
+    assert merged['z'].tolist() == [[1, 1], [1, 1]]
+
+
+LAYOUT = {'G': {'content': {'line': {}, 'map': {}}}}
+
+
+def pack(layout = LAYOUT, **parts):
+    return {'layout': layout, 'iter': 1, 'data': {'G': parts}}
+
+
+def test_session_sends_layout_once_and_only_changed_parts():
+    encoder = SessionEncoder(keyframe_interval=60)
+    line, image = {'x': np.arange(3)}, {'z': np.zeros((2, 2))}
+
+    header, payload = encoder.encode(pack(line=line, map=image))
+    assert header['kind'] == LAYOUT_FRAME
+    assert payload['layout'] == LAYOUT
+    assert set(payload['data']['G']) == {'line', 'map'}
+
+    header, payload = encoder.encode(pack(line=line, map={'z': np.ones((2, 2))}))
+    assert header['kind'] == DATA_FRAME
+    assert 'layout' not in payload
+    assert set(payload['data']['G']) == {'map'}
+    assert payload['iter'] == 1
+
+    # Parts left out of changed are not even compared
+    _, payload = encoder.encode(pack(line={'x': np.arange(4)}, map=image), changed={('G', 'map')})
+    assert set(payload['data']['G']) == {'map'}
+
+
+def test_session_repeats_key_frames_and_restarts_on_new_layouts():
+    encoder = SessionEncoder(keyframe_interval=0)
+    line = {'x': np.arange(3)}
+    encoder.encode(pack(line=line))
+    header, payload = encoder.encode(pack(line=line))
+    assert header['kind'] == LAYOUT_FRAME
+    assert set(payload['data']['G']) == {'line'}
+
+    encoder = SessionEncoder(keyframe_interval=60)
+    encoder.encode(pack(line=line))
+    other = {'G': {'content': {'line': {}}}}
+    header, _ = encoder.encode(pack(layout=other, line=line))
+    assert header['kind'] == LAYOUT_FRAME
+
+
+def test_decoder_waits_for_a_key_frame_of_the_session():
+    first, restarted = SessionEncoder(keyframe_interval=60), SessionEncoder(keyframe_interval=60)
+    decoder = SessionDecoder()
+    key_frame = first.encode(pack(line={'x': np.arange(3)}))
+    data_frame = first.encode(pack(line={'x': np.arange(4)}))
+
+    assert decoder.decode(*data_frame) == (False, None)
+    layout_changed, payload = decoder.decode(*key_frame)
+    assert layout_changed and decoder.layout == LAYOUT
+    assert decoder.decode(*data_frame)[1]['data']['G']['line']['x'].tolist() == [0, 1, 2, 3]
+
+    # Same layout, but a new session: its data frames wait for its key frame
+    restarted_key = restarted.encode(pack(line={'x': np.arange(1)}))
+    restarted_data = restarted.encode(pack(line={'x': np.arange(2)}))
+    assert restarted_key[0]['session'] != key_frame[0]['session']
+    assert decoder.decode(*restarted_data) == (False, None)
+    assert decoder.decode(*restarted_key)[0] is False
+    assert decoder.session == restarted.session
+
+
+APPEND_LAYOUT = {'G': {'content': {'trace': {'mode': APPEND_MODE}, 'map': {}}}}
+
+
+def stream(encoder, decoder, conflator, **parts):
+    header, payload = encoder.encode(pack(layout=APPEND_LAYOUT, **parts))
+    layout_changed, payload = decoder.decode(header, payload)
+    if payload is not None:
+        conflator.push(layout_changed, decoder.layout, payload, decoder.session)
+
+
+def test_conflator_appends_keeps_newest_and_restarts():
+    decoder, conflator = SessionDecoder(), Conflator()
+    encoder = SessionEncoder(keyframe_interval=60)
+    stream(encoder, decoder, conflator, trace={'x': np.arange(2)}, map={'z': np.zeros(2)})
+    stream(encoder, decoder, conflator, trace={'x': np.arange(2, 3)}, map={'z': np.ones(2)})
+
+    layout_changed, layout, frame = conflator.take()
+    assert layout_changed and layout == APPEND_LAYOUT
+    assert frame['data']['G']['trace']['x'].tolist() == [0, 1, 2]
+    assert frame['data']['G']['map']['z'].tolist() == [1, 1]
+    assert conflator.take() is None
+
+    # Later frames extend the history, also after it was taken
+    stream(encoder, decoder, conflator, trace={'x': np.arange(3, 5)}, map={'z': np.ones(2)})
+    layout_changed, _, frame = conflator.take()
+    assert not layout_changed
+    assert frame['data']['G']['trace']['x'].tolist() == [0, 1, 2, 3, 4]
+    assert 'map' not in frame['data']['G']
+
+    # A restarted producer with the same layout starts a new series
+    encoder = SessionEncoder(keyframe_interval=60)
+    stream(encoder, decoder, conflator, trace={'x': np.arange(2)}, map={'z': np.ones(2)})
+    layout_changed, _, frame = conflator.take()
+    assert not layout_changed
+    assert frame['data']['G']['trace']['x'].tolist() == [0, 1]
+
+
+def test_conflator_drops_everything_on_a_layout_change():
+    conflator = Conflator()
+    conflator.push(True, APPEND_LAYOUT, {'iter': 1, 'data': {'G': {'trace': {'x': np.arange(3)},
+                                                                   'map': {'z': np.zeros(2)}}}})
+    other = {'G': {'content': {'trace': {'mode': APPEND_MODE}}}}
+    conflator.push(True, other, {'iter': 2, 'data': {'G': {'trace': {'x': np.arange(1)}}}})
+
+    layout_changed, layout, frame = conflator.take()
+    assert layout_changed and layout == other
+    assert frame['iter'] == 2
+    assert list(frame['data']['G']) == ['trace']
+    assert frame['data']['G']['trace']['x'].tolist() == [0]
+
+
+def test_stale_ring_part_leaves_the_rest_of_the_frame(sockets, ring):
+    sender, receiver = sockets
+    encoder, decoder = SessionEncoder(keyframe_interval=60), SessionDecoder()
+    data = pack(layout=APPEND_LAYOUT, trace={'x': np.arange(2**14, dtype=np.float64)},
+                map={'z': np.ones(10_000)})
+    encoder.send(sender, data, topic=b'run', ring=ring)
+    for _ in range(5):
+        ring.put(np.zeros(2**15))
+
+    rings = {}
+    try:
+        _, header, payload = recv_data(receiver, rings=rings)
+    finally:
+        for attached in rings.values():
+            attached.close()
+    assert header['stale'] == [['data', 'G', 'map', 'z']]
+
+    layout_changed, payload = decoder.decode(header, payload)
+    assert layout_changed and payload['iter'] == 1
+    assert list(payload['data']['G']) == ['trace']
+    assert payload['data']['G']['trace']['x'].size == 2**14
+
+
+MAP_LAYOUT = {'P': {'content': {'m': {'type': 'HeatMap'}, 'trace': {'mode': APPEND_MODE}}}}
+
+
+def receive(viewer, decoder):
+    _, header, payload = recv_data(viewer)
+    return decoder.decode(header, payload)[1]
+
+
+@pytest.fixture
+def live():
+    """
+    Publisher with a shared memory ring and a function returning the next
+    payload a viewer subscribed to it decodes.
+    """
+    context = zmq.Context.instance()
+    address = f"inproc://publisher-{np.random.randint(2**31)}"
+    publisher = Publisher(address, MAP_LAYOUT, topic=b'run', context=context,
+                          min_interval=0, shared_memory=2**20)
+    viewer, decoder = context.socket(zmq.SUB), SessionDecoder()
+    viewer.setsockopt(zmq.SUBSCRIBE, b'')
+    viewer.connect(address)
+    # PUB drops frames until the subscription arrived
+    while not viewer.poll(10):
+        publisher.publish(force=True)
+    while viewer.poll(0):
+        receive(viewer, decoder)
+    yield publisher, lambda: receive(viewer, decoder)
+    viewer.close(linger=0)
+    publisher.close()
+
+
+def test_queued_heatmap_patches_are_all_sent(live):
+    publisher, next_payload = live
+    publisher.update('P', 'm', z_rows={0: np.ones(3)})
+    publisher.update('P', 'm', z_rows={1: np.full(3, 2.0)})
+    publisher.update('P', 'm', z_region={'start': (0, 0), 'values': np.zeros((2**13, 2))})
+    assert publisher.publish(force=True)
+
+    patches = next_payload()['data']['P']['m'][PATCHES_KEY]
+    assert [list(patch) for patch in patches] == [['z_rows'], ['z_rows'], ['z_region']]
+    assert patches[1]['z_rows']['1'].tolist() == [2, 2, 2]
+    # Patches are applied once, they never go through the ring
+    assert publisher.ring.written == 0
+
+
+def test_patches_and_append_parts_are_inline():
+    data = {'P': {'m': {'z_rows': {0: np.ones(3)}}, 'other': {'z': np.ones((2, 2))}}}
+    assert inline_paths(MAP_LAYOUT, data) == {('data', 'P', 'm'), ('data', 'P', 'trace')}
+
+
+def test_publisher_batches_appends_into_one_frame(live):
+    publisher, next_payload = live
+    for start in range(0, 9, 3):
+        publisher.append('P', 'trace', x=np.arange(start, start + 3), y=start)
+    with pytest.raises(ValueError):
+        publisher.append('P', 'm', z=np.ones(3))
+    assert publisher.publish(force=True)
+
+    trace = next_payload()['data']['P']['trace']
+    assert trace['x'].tolist() == list(range(9))
+    assert trace['y'].tolist() == [0, 3, 6]
+
+    # Batched points are sent once
+    assert publisher.publish(force=True)
+    assert 'P' not in next_payload()['data']
+
+
+def test_publisher_encodes_only_updated_parts(live, monkeypatch):
+    publisher, next_payload = live
+    encoded = []
+    encode = publisher.session.encode
+    def recorded_encode(data_pack, changed = None):
+        header, payload = encode(data_pack, changed=changed)
+        encoded.append((changed, header['kind']))
+        return header, payload
+    monkeypatch.setattr(publisher.session, 'encode', recorded_encode)
+
+    publisher.update('P', 'm', z=np.zeros((2, 2)))
+    assert publisher.publish(force=True)
+    assert set(next_payload()['data']['P']) == {'m'}
+
+    publisher.append('P', 'trace', x=[1.0])
+    assert publisher.publish(force=True)
+    assert set(next_payload()['data']['P']) == {'trace'}
+    assert encoded == [({('P', 'm')}, DATA_FRAME), (set(), DATA_FRAME)]
+
+
+def test_publisher_waits_for_credit_and_backs_off():
+    context = zmq.Context.instance()
+    suffix = np.random.randint(2**31)
+    ack_endpoint = f"inproc://acks-{suffix}"
+    publisher = Publisher(f"inproc://credit-{suffix}", MAP_LAYOUT, topic=b'run', context=context,
+                          ack_endpoint=ack_endpoint, min_interval=0.01, max_interval=0.3,
+                          credit_window=2)
+    acknowledger = context.socket(zmq.PUSH)
+    acknowledger.connect(ack_endpoint)
+    try:
+        for credit in (1, 0):
+            publisher.update('P', 'm', z=np.full(2, credit))
+            assert publisher.publish()
+            assert publisher.credit == credit
+            time.sleep(0.02)
+
+        # Without credit only max_interval lets a frame through, then slower
+        publisher.update('P', 'm', z=np.ones(2))
+        assert not publisher.publish()
+        time.sleep(0.3)
+        assert publisher.publish()
+        assert publisher.interval == pytest.approx(0.01 * BACKOFF)
+
+        acknowledger.send_multipart([b'run', b'2'])
+        assert publisher.ack_socket.poll(1000)
+        time.sleep(0.03)
+        publisher.update('P', 'm', z=np.zeros(2))
+        assert publisher.publish()
+        assert publisher.credit == 1
+        assert publisher.interval == pytest.approx(0.01 * BACKOFF * SPEEDUP)
+    finally:
+        acknowledger.close(linger=0)
+        publisher.close()
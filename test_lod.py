@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from lod import minmax_decimate, lttb_decimate, LineDecimator, LTTB
+
+
+@pytest.fixture
+def trace():
+    x = np.linspace(0, 10, 100_000)
+    y = np.sin(x)
+    y[12_345] = 5.0
+    y[67_890] = -5.0
+    return x, y
+
+
+@pytest.mark.parametrize('decimate', [minmax_decimate, lttb_decimate])
+def test_decimation_keeps_endpoints_and_extremes(trace, decimate):
+    x, y = trace
+    x_out, y_out = decimate(x, y, 500)
+
+    assert x_out.size <= 1001
+    assert (x_out[0], y_out[0]) == (x[0], y[0])
+    assert (x_out[-1], y_out[-1]) == (x[-1], y[-1])
+    assert y_out.max() == 5.0 and y_out.min() == -5.0
+    assert np.all(np.diff(x_out) >= 0)
+
+
+def test_minmax_keeps_gaps_and_ignores_single_nans(trace):
+    x, y = trace
+    y = y.copy()
+    y[:1000] = np.nan
+    y[50_000] = np.nan
+    _, y_out = minmax_decimate(x, y, 500)
+
+    # 1000 points are about 5 buckets, the single NaN is ignored
+    gap = np.flatnonzero(np.isnan(y_out))
+    assert 8 <= gap.size <= 12
+    assert gap.tolist() == list(range(gap.size))
+
+
+@pytest.mark.parametrize('decimate', [minmax_decimate, lttb_decimate])
+def test_short_traces_are_not_decimated(decimate):
+    x, y = np.arange(10.0), np.arange(10.0)
+    x_out, y_out = decimate(x, y, 500)
+    assert x_out is x and y_out is y
+
+
+def test_decimator_cuts_to_the_visible_range(trace):
+    decimator = LineDecimator(method=LTTB)
+    decimator.setData(*trace)
+    x_out, _ = decimator.decimate(x_range=(2, 3), width=100)
+
+    assert x_out.size <= 200
+    assert x_out[0] < 2 and x_out[-1] > 3
+    assert x_out[1] >= 2 and x_out[-2] <= 3
+    assert decimator.decimate(x_range=(2, 3), width=100)[0] is x_out